@@ -0,0 +1,556 @@
+"""Benchmarks for the lecture bot.
+
+Usage:
+    python bench.py listing [--folders N] [--files N] [--rounds N]
+    python bench.py webhook [--url URL] [--secret S] [--users N] [--updates N]
+    python bench.py load [--backend memory|postgres] [--users N] [--steps N] [--taps N]
+                         [--admins N] [--rounds N] [--album N] [--throttle]
+                         [--depth N] [--width N] [--files N] [--api-latency MS] [--db-latency MS]
+
+'listing' needs the same DATABASE_URL / PG* environment variables as bot.py;
+its data is written under a throwaway folder and removed afterwards.
+'webhook' plays the part of Telegram and posts synthetic updates to a bot
+running with BOT_MODE=webhook.
+'load' runs the real handlers in-process against a fake Bot API, through
+the same per-user update processor (and, with --throttle, the incoming
+throttle) as a running bot: simulated students press /start and then click
+through the keyboards they are shown, while simulated admins create folders
+and upload single documents and albums into them. With --backend memory no
+database is needed; --backend postgres seeds a generated tree under a
+throwaway folder like 'listing' does.
+"""
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import random
+import statistics
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import bot
+
+BENCH_ROOT = "/__bench__"
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def report(label, samples):
+    print(
+        f"{label:<24} p50={percentile(samples, 50) * 1000:7.2f} ms  "
+        f"p99={percentile(samples, 99) * 1000:7.2f} ms  "
+        f"mean={statistics.mean(samples) * 1000:7.2f} ms"
+    )
+
+
+def legacy_folder_structure(manager, path):
+    """The original two-query listing, kept only as a baseline"""
+    from psycopg2.extras import RealDictCursor
+
+    with manager._cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute('SELECT name, id FROM folders WHERE parent_path = %s ORDER BY name', (path,))
+        subfolders = {row['name']: row['id'] for row in cur.fetchall()}
+        cur.execute('SELECT filename, id FROM files WHERE folder_path = %s ORDER BY filename', (path,))
+        files = {row['filename']: row['id'] for row in cur.fetchall()}
+    return {'subfolders': subfolders, 'files': files}
+
+
+def seed_listing(manager, folders, files):
+    manager.create_folder('/', BENCH_ROOT.lstrip('/'))
+    for i in range(folders):
+        manager.create_folder(BENCH_ROOT, f"folder_{i:04d}")
+    for i in range(files):
+        manager.add_file(BENCH_ROOT, f"lecture_{i:04d}.pdf", f"bench-file-{i}", 'document', 1024)
+
+
+def bench_listing(args):
+    if not bot.init_database():
+        raise SystemExit("database unavailable, set DATABASE_URL or the PG* variables")
+    manager = bot.db.manager
+    # Measure the query itself, not the listing cache
+    manager.cache = bot.FolderCache(maxsize=0)
+
+    seed_listing(manager, args.folders, args.files)
+    try:
+        assert legacy_folder_structure(manager, BENCH_ROOT) == manager.get_folder_structure(BENCH_ROOT)
+
+        legacy, combined = [], []
+        for _ in range(args.rounds):
+            started = time.perf_counter()
+            legacy_folder_structure(manager, BENCH_ROOT)
+            legacy.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            manager.get_folder_structure(BENCH_ROOT)
+            combined.append(time.perf_counter() - started)
+
+        print(f"Listing {args.folders} folders + {args.files} files, {args.rounds} rounds")
+        report("two queries (legacy)", legacy)
+        report("single UNION ALL", combined)
+    finally:
+        manager.delete_folder('/', BENCH_ROOT.lstrip('/'))
+
+
+def fake_user(user_id, username=None):
+    return {"id": user_id, "is_bot": False, "first_name": f"Student {user_id}", "username": username or f"student{user_id}"}
+
+
+def fake_document(file_unique_id, filename, size=1024 * 1024):
+    return {"file_id": f"bench-{file_unique_id}", "file_unique_id": file_unique_id, "file_name": filename, "file_size": size}
+
+
+def fake_message(message_id, user_id, text=None, username=None, document=None, media_group_id=None):
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": fake_user(user_id, username),
+    }
+    if document is not None:
+        message["document"] = document
+    if media_group_id is not None:
+        message["media_group_id"] = media_group_id
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return message
+
+
+def fake_update(update_id, user_id, text=None, data=None, username=None, document=None, media_group_id=None):
+    """Update JSON as Telegram would send it: a command/text message, an upload or a button press"""
+    if data is None:
+        return {"update_id": update_id, "message": fake_message(update_id, user_id, text, username, document, media_group_id)}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": fake_user(user_id, username),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": fake_message(update_id, user_id, "📁 Main Menu"),
+        },
+    }
+
+
+def bench_webhook(args):
+    headers = {"Content-Type": "application/json"}
+    if args.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+
+    def post(update_id):
+        user_id = 1000 + update_id % args.users
+        update = fake_update(update_id, user_id, data="browse_folders") if update_id % 2 else fake_update(update_id, user_id, text="/start")
+        request = urllib.request.Request(args.url, data=json.dumps(update).encode(), headers=headers)
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        return status, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        results = list(pool.map(post, range(1, args.updates + 1)))
+    elapsed = time.perf_counter() - started
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print(f"Posted {args.updates} updates from {args.users} users in {elapsed:.2f}s "
+          f"({args.updates / elapsed:.0f} updates/s), HTTP status counts: {statuses}")
+    report("webhook accept latency", [latency for _, latency in results])
+
+
+class FakeTelegram(BaseRequest):
+    """Bot API transport that answers every call locally.
+
+    Remembers the last inline keyboard shown in each chat so simulated users
+    can click through it.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.keyboards = {}  # chat_id -> callback data of the last keyboard
+        self._message_ids = itertools.count(1_000_000)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, chat_id, text):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text or "",
+        }
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = params.get("chat_id")
+        markup = params.get("reply_markup")
+        if chat_id is not None and isinstance(markup, dict) and "inline_keyboard" in markup:
+            self.keyboards[int(chat_id)] = [
+                button["callback_data"] for row in markup["inline_keyboard"] for button in row
+                if "callback_data" in button
+            ]
+
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif endpoint == "sendMediaGroup":
+            result = [self._message(chat_id, None) for _ in params.get("media", ())]
+        elif endpoint.startswith(("send", "edit")):
+            result = self._message(chat_id, params.get("text"))
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class MemoryDatabaseManager:
+    """In-memory stand-in for DatabaseManager holding a generated tree.
+
+    Implements the read path the student-facing handlers use; `latency`
+    adds a fixed delay per call to approximate a database round trip.
+    """
+
+    def __init__(self, depth, width, files, latency=0.0):
+        self.latency = latency
+        self.cache = bot.FolderCache()
+        self.file_cache = bot.FolderCache(maxsize=bot.FILE_CACHE_SIZE, path_of=lambda key, record: record["folder_path"])
+        self.reconnects = 0
+        self.has_trgm = False
+        self.folders = {}  # id -> (path, name, parent_path)
+        self.files = {}  # id -> (filename, folder_path, file_id, file_type, file_size)
+        self.unique_ids = {}  # file id -> file_unique_id
+        self.children = {}  # path -> ([(name, id)], [(filename, id)])
+        self._add_folder("/", "", None)
+        self._populate("/", depth, width, files)
+
+    def _add_folder(self, path, name, parent_path):
+        folder_id = len(self.folders) + 1
+        self.folders[folder_id] = (path, name, parent_path)
+        self.children[path] = ([], [])
+        if parent_path is not None:
+            self.children[parent_path][0].append((name, folder_id))
+
+    def _populate(self, path, depth, width, files):
+        for i in range(files):
+            file_pk = len(self.files) + 1
+            filename = f"lecture_{i:03d}.pdf"
+            self.files[file_pk] = (filename, path, f"bench-file-{file_pk}", "document", 1024 * 1024)
+            self.children[path][1].append((filename, file_pk))
+        if depth:
+            for i in range(width):
+                name = f"folder_{i:02d}"
+                child = bot.join_path(path, name)
+                self._add_folder(child, name, path)
+                self._populate(child, depth - 1, width, files)
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_folder_structure(self, path="/"):
+        self._wait()
+        subfolders, files = self.children.get(path, ([], []))
+        return {"subfolders": dict(subfolders), "files": dict(files)}
+
+    def get_folder_page(self, path="/", page=0, page_size=bot.FOLDER_PAGE_SIZE, kind=None):
+        self._wait()
+        subfolders, files = self.children.get(path, ([], []))
+        subfolders = subfolders if kind != "files" else []
+        files = files if kind != "subfolders" else []
+        rows = [(0, name, row_id) for name, row_id in subfolders] + [(1, name, row_id) for name, row_id in files]
+        window = rows[page * page_size:(page + 1) * page_size]
+        return {
+            "subfolders": {name: row_id for kind, name, row_id in window if kind == 0},
+            "files": {name: row_id for kind, name, row_id in window if kind == 1},
+            "page": page,
+            "has_next": len(rows) > (page + 1) * page_size,
+            "has_files": bool(files),
+        }
+
+    def get_folder(self, folder_id):
+        self._wait()
+        folder = self.folders.get(folder_id)
+        return dict(zip(("id", "path", "name", "parent_path"), (folder_id, *folder))) if folder else None
+
+    def get_file(self, file_pk):
+        self._wait()
+        record = self.files.get(file_pk)
+        if not record:
+            return None
+        filename, folder_path, file_id, file_type, _ = record
+        return {"id": file_pk, "filename": filename, "folder_path": folder_path, "file_id": file_id, "file_type": file_type}
+
+    def get_file_id(self, file_pk):
+        self._wait()
+        record = self.files.get(file_pk)
+        return record[2] if record else None
+
+    def _files_under(self, path):
+        return [record for record in self.files.values() if bot.is_same_or_descendant(record[1], path)]
+
+    def get_folder_files(self, path, recursive=False, limit=bot.DOWNLOAD_ALL_MAX):
+        self._wait()
+        records = self._files_under(path) if recursive else [r for r in self.files.values() if r[1] == path]
+        return [(filename, file_id, file_type) for filename, _, file_id, file_type, _ in records[:limit]]
+
+    def get_folder_stats(self, path):
+        self._wait()
+        records = self._files_under(path)
+        folders = sum(1 for folder_path, _, _ in self.folders.values() if folder_path != path and bot.is_same_or_descendant(folder_path, path))
+        return folders, len(records), sum(record[4] for record in records)
+
+    def get_stats(self):
+        return self.get_folder_stats("/")
+
+    def get_course_stats(self, limit=10):
+        self._wait()
+        courses = []
+        for name, folder_id in self.children["/"][0]:
+            records = self._files_under(self.folders[folder_id][0])
+            courses.append((name, len(records), sum(record[4] for record in records)))
+        return sorted(courses, key=lambda course: (-course[2], course[0]))[:limit]
+
+    def search(self, text, page=0, page_size=bot.SEARCH_PAGE_SIZE, files_only=False):
+        self._wait()
+        needle = text.lower()
+        hits = [
+            {"kind": "file", "id": pk, "name": filename, "path": folder_path, "file_id": file_id, "file_type": file_type}
+            for pk, (filename, folder_path, file_id, file_type, _) in self.files.items() if needle in filename.lower()
+        ]
+        if not files_only:
+            hits += [
+                {"kind": "folder", "id": folder_id, "name": name, "path": path, "file_id": None, "file_type": None}
+                for folder_id, (path, name, _) in self.folders.items() if path != "/" and needle in name.lower()
+            ]
+        window = hits[page * page_size:(page + 1) * page_size + 1]
+        return window[:page_size], len(window) > page_size
+
+    def create_folder(self, parent_path, folder_name):
+        self._wait()
+        path = bot.join_path(parent_path, folder_name)
+        if path in self.children or parent_path not in self.children:
+            return False
+        self._add_folder(path, folder_name, parent_path)
+        return True
+
+    def add_files(self, folder_path, files):
+        self._wait()
+        listed = self.children[folder_path][1]
+        existing = {filename: file_pk for filename, file_pk in listed}
+        for filename, file_id, file_type, file_size, file_unique_id in files:
+            file_pk = existing.get(filename)
+            if file_pk is None:
+                file_pk = existing[filename] = len(self.files) + 1
+                listed.append((filename, file_pk))
+            self.files[file_pk] = (filename, folder_path, file_id, file_type, file_size)
+            self.unique_ids[file_pk] = file_unique_id
+        return True
+
+    def find_copies(self, file_unique_ids):
+        self._wait()
+        wanted = set(file_unique_ids)
+        copies = {}
+        for file_pk, file_unique_id in self.unique_ids.items():
+            if file_unique_id in wanted:
+                filename, folder_path = self.files[file_pk][:2]
+                copies.setdefault(file_unique_id, []).append((folder_path, filename))
+        return copies
+
+    def load_session(self, user_id):
+        return None
+
+    def save_sessions(self, rows):
+        return True
+
+    def close(self):
+        pass
+
+
+def seed_load(manager, depth, width, files):
+    """Build the same generated tree as MemoryDatabaseManager under BENCH_ROOT"""
+    def populate(path, level):
+        manager.add_files(path, [(f"lecture_{i:03d}.pdf", f"bench-file-{path}-{i}", "document", 1024 * 1024, None)
+                                 for i in range(files)])
+        if level:
+            for i in range(width):
+                manager.create_folder(path, f"folder_{i:02d}")
+                populate(bot.join_path(path, f"folder_{i:02d}"), level - 1)
+
+    manager.create_folder("/", BENCH_ROOT.lstrip("/"))
+    populate(BENCH_ROOT, depth)
+
+
+# Buttons a browsing student presses; admin, close and bulk download are left out
+LOAD_ACTIONS = {"browse_folders", "open_folder", "page", "back", "download"}
+BENCH_ADMIN = "bench_admin"
+
+
+async def run_load(args, telegram, start_data="browse_folders"):
+    app = bot.build_application("123456:BENCH", request=telegram, rate_limited=args.rate_limit, throttled=args.throttle)
+    await app.initialize()
+    # Running, so tasks the handlers create are awaited by app.stop()
+    await app.start()
+    update_ids = itertools.count(1)
+    latencies = {}
+    uploads = Counter()
+
+    async def dispatch(user_id, action, **kwargs):
+        update = Update.de_json(fake_update(next(update_ids), user_id, **kwargs), app.bot)
+        started = time.perf_counter()
+        # The path Application takes for every fetched update: per-user ordering and throttling included
+        await app.update_processor.process_update(update, app.process_update(update))
+        latencies.setdefault(action, []).append(time.perf_counter() - started)
+
+    async def student(user_id):
+        rng = random.Random(user_id)
+        await dispatch(user_id, "/start", text="/start")
+        for _ in range(args.steps):
+            choices = [data for data in telegram.keyboards.get(user_id, ()) if data.split("|")[0] in LOAD_ACTIONS]
+            data = rng.choice(choices) if choices else "browse_folders"
+            # --taps > 1: an impatient student pressing the same button several times at once
+            await asyncio.gather(*(dispatch(user_id, data.split("|")[0], data=data) for _ in range(args.taps)))
+
+    async def admin(user_id):
+        rng = random.Random(user_id)
+        press = functools.partial(dispatch, user_id, username=BENCH_ADMIN)
+        await press("/start", text="/start")
+        for round_no in range(args.rounds):
+            await press("browse_folders", data=start_data)
+            folders = [data for data in telegram.keyboards.get(user_id, ()) if data.startswith("open_folder|")]
+            if folders:
+                await press("open_folder", data=rng.choice(folders))
+            await press("admin_current", data="admin_current")
+            await press("create_folder_current", data="create_folder_current")
+            await press("handle_text", text=f"new_{user_id}_{round_no}")
+            await press("upload_current", data="upload_current")
+            await press("handle_file", document=fake_document(f"{user_id}-{round_no}", f"notes_{round_no}.pdf"))
+            # An album arrives as one message per file; some contents were uploaded before
+            album = f"album-{user_id}-{round_no}"
+            documents = [fake_document(f"{user_id}-{rng.randrange(args.rounds * 2)}", f"slide_{i:02d}.pdf")
+                         for i in range(args.album)]
+            await asyncio.gather(*(press("handle_file", document=document, media_group_id=album) for document in documents))
+            uploads["sent"] += 1 + len(documents)
+            # What the batching window does after the last file, without waiting it out
+            started = time.perf_counter()
+            await bot.upload_batcher.flush(user_id)
+            latencies.setdefault("upload_flush", []).append(time.perf_counter() - started)
+
+    db_calls = bot.metrics.count("bot_db_query_seconds")
+    add_calls = bot.metrics.count("bot_db_query_seconds", method="add_files")
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(student(1000 + i) for i in range(args.users)),
+                             *(admin(1 + i) for i in range(args.admins)))
+    finally:
+        elapsed = time.perf_counter() - started
+        await app.stop()
+        await app.shutdown()
+    db_calls = bot.metrics.count("bot_db_query_seconds") - db_calls
+    add_calls = bot.metrics.count("bot_db_query_seconds", method="add_files") - add_calls
+
+    samples = [latency for action_samples in latencies.values() for latency in action_samples]
+    print(f"{len(samples)} updates from {args.users} users in {elapsed:.2f}s "
+          f"({len(samples) / elapsed:.0f} updates/s, backend={args.backend})")
+    print(f"DB calls per update: {db_calls / len(samples):.2f}  "
+          f"Bot API calls per update: {sum(telegram.calls.values()) / len(samples):.2f}")
+    if args.admins:
+        print(f"Uploads: {uploads['sent']} files sent by {args.admins} admins, stored in {add_calls} bulk inserts")
+    if args.throttle:
+        counters = bot.update_throttle.counters
+        print(f"Throttle: {counters['admitted']} admitted, {counters['coalesced']} coalesced, "
+              f"{counters['dropped_user']} dropped per user, {counters['dropped_global']} dropped globally")
+    report("all updates", samples)
+    for action, action_samples in sorted(latencies.items()):
+        report(f"  {action} (n={len(action_samples)})", action_samples)
+
+
+def bench_load(args):
+    # Per-update INFO logging would dominate the measurement
+    bot.logger.setLevel(logging.WARNING)
+    if args.backend == "memory":
+        manager = MemoryDatabaseManager(args.depth, args.width, args.files, args.db_latency / 1000)
+        bot.db = bot.AsyncDatabaseManager(manager)
+        start_data = "browse_folders"
+    elif not bot.init_database():
+        raise SystemExit("database unavailable, set DATABASE_URL or the PG* variables")
+    else:
+        seed_load(bot.db.manager, args.depth, args.width, args.files)
+        # Admins only write below the throwaway folder
+        root_id = bot.db.manager.get_folder_structure("/")["subfolders"][BENCH_ROOT.lstrip("/")]
+        start_data = f"open_folder|{root_id}"
+    bot.sessions = bot.SessionStore(bot.MemorySessionBackend())
+    bot.ADMIN_USERNAME = BENCH_ADMIN
+
+    try:
+        asyncio.run(run_load(args, FakeTelegram(args.api_latency / 1000), start_data))
+    finally:
+        if args.backend == "postgres":
+            bot.db.manager.delete_folder("/", BENCH_ROOT.lstrip("/"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    listing = commands.add_parser("listing", help="compare folder listing query strategies")
+    listing.add_argument("--folders", type=int, default=20)
+    listing.add_argument("--files", type=int, default=100)
+    listing.add_argument("--rounds", type=int, default=500)
+    listing.set_defaults(func=bench_listing)
+
+    webhook = commands.add_parser("webhook", help="post synthetic updates to a local webhook")
+    webhook.add_argument("--url", default=f"http://127.0.0.1:{bot.WEBHOOK_PORT}/{bot.WEBHOOK_PATH}")
+    webhook.add_argument("--secret", default=bot.WEBHOOK_SECRET)
+    webhook.add_argument("--users", type=int, default=20)
+    webhook.add_argument("--updates", type=int, default=200)
+    webhook.set_defaults(func=bench_webhook)
+
+    load = commands.add_parser("load", help="drive the handlers in-process against a fake Bot API")
+    load.add_argument("--backend", choices=("memory", "postgres"), default="memory")
+    load.add_argument("--users", type=int, default=50)
+    load.add_argument("--steps", type=int, default=20, help="button presses per user after /start")
+    load.add_argument("--taps", type=int, default=1, help="times a student presses each button at once")
+    load.add_argument("--admins", type=int, default=2, help="admins creating folders and uploading")
+    load.add_argument("--rounds", type=int, default=5, help="folders each admin creates and uploads into")
+    load.add_argument("--album", type=int, default=6, help="documents per uploaded album")
+    load.add_argument("--depth", type=int, default=3)
+    load.add_argument("--width", type=int, default=4)
+    load.add_argument("--files", type=int, default=12, help="files per folder")
+    load.add_argument("--api-latency", type=float, default=0.0, help="simulated Bot API round trip in ms")
+    load.add_argument("--db-latency", type=float, default=0.0, help="simulated query time in ms (memory backend)")
+    load.add_argument("--rate-limit", action="store_true", help="keep the outgoing rate limiter enabled")
+    load.add_argument("--throttle", action="store_true", help="keep the incoming update throttle enabled")
+    load.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,45 @@
 import os
+import argparse
 import json
 import logging
+import select
+import sys
+import time
+import uuid
+import asyncio
+import functools
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager, suppress
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+    InlineQueryResultCachedAudio,
+    InlineQueryResultCachedDocument,
+    InlineQueryResultCachedPhoto,
+    InlineQueryResultCachedVideo,
+)
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
@@ -37,116 +68,1040 @@ if not DATABASE_URL:
     if all([PGHOST, PGDATABASE, PGUSER, PGPASSWORD]):
         DATABASE_URL = f"postgresql://{PGUSER}:{PGPASSWORD}@{PGHOST}:{PGPORT}/{PGDATABASE}"
 
+# Update delivery: "polling" (default, good for local runs) or "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # public base URL Telegram posts to, e.g. https://bot.example.com
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8443")))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # checked against X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Polling keeps its old behaviour of skipping the backlog; webhooks keep it by default
+DROP_PENDING_UPDATES = os.environ.get(
+    "DROP_PENDING_UPDATES", "true" if BOT_MODE == "polling" else "false"
+).lower() in ("1", "true", "yes")
+
+# Updates handled at the same time (updates from one user always run in order)
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "64"))
+
+# Navigation state: "postgres" (shared by replicas), "file" (local dev) or "memory"
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "postgres").lower()
+SESSION_FILE = os.environ.get("SESSION_FILE", "sessions.json")
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", "3600"))  # seconds before an idle user is evicted from memory
+SESSION_MAX_USERS = int(os.environ.get("SESSION_MAX_USERS", "10000"))  # users kept in memory
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", "5"))  # seconds between write-behind flushes
+SESSION_REFRESH_INTERVAL = float(os.environ.get("SESSION_REFRESH_INTERVAL", "0"))  # seconds before a clean session is re-read from a shared backend; 0 never re-reads
+
+# Uploads are collected into one bulk insert until no new file arrives for this long
+UPLOAD_BATCH_WINDOW = float(os.environ.get("UPLOAD_BATCH_WINDOW", "2"))  # seconds
+UPLOAD_BATCH_MAX = int(os.environ.get("UPLOAD_BATCH_MAX", "100"))  # files per batch
+
+# Prometheus-style /metrics endpoint; port 0 disables it
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+# Serve folder listings and file lookups from an in-memory copy of the whole
+# tree, kept current through Postgres LISTEN/NOTIFY (useful with several replicas)
+SNAPSHOT_MODE = os.environ.get("SNAPSHOT_MODE", "false").lower() in ("1", "true", "yes")
+SNAPSHOT_CHANNEL = "lectures_changes"
+
+# Worker threads used to run blocking database calls off the event loop
+DB_WORKERS = int(os.environ.get("DB_WORKERS", "8"))
+
+# Connection pool settings
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", str(DB_WORKERS)))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", "10"))  # seconds
+DB_STATEMENT_TIMEOUT = int(os.environ.get("DB_STATEMENT_TIMEOUT", "15000"))  # milliseconds
+DB_PING_INTERVAL = float(os.environ.get("DB_PING_INTERVAL", "30"))  # validate connections idle longer than this
+DB_RETRY_ATTEMPTS = int(os.environ.get("DB_RETRY_ATTEMPTS", "5"))
+DB_RETRY_BACKOFF = float(os.environ.get("DB_RETRY_BACKOFF", "0.5"))  # first retry delay, doubled each attempt
+DB_RETRY_BACKOFF_MAX = float(os.environ.get("DB_RETRY_BACKOFF_MAX", "8"))
+
+# Rows (folders + files) shown per page of a folder keyboard
+FOLDER_PAGE_SIZE = int(os.environ.get("FOLDER_PAGE_SIZE", "20"))
+
+# Search hits per page of /search results and inline query answers
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "10"))
+
+# "Download all": files sent per request at most
+DOWNLOAD_ALL_MAX = int(os.environ.get("DOWNLOAD_ALL_MAX", "200"))
+
+# Rows per INSERT statement when importing a whole tree
+IMPORT_PAGE_SIZE = int(os.environ.get("IMPORT_PAGE_SIZE", "1000"))
+
+# Message ids remembered per chat for "Clear Interface"
+TRACKED_MESSAGES_PER_CHAT = int(os.environ.get("TRACKED_MESSAGES_PER_CHAT", "30"))
+TRACKED_CHATS_MAX = int(os.environ.get("TRACKED_CHATS_MAX", "10000"))
+
+# Outbound Telegram API rate limits (token buckets)
+RATE_LIMIT_GLOBAL = float(os.environ.get("RATE_LIMIT_GLOBAL", "30"))  # requests/second for the whole bot
+RATE_LIMIT_CHAT = float(os.environ.get("RATE_LIMIT_CHAT", "1"))  # messages/second per private chat
+RATE_LIMIT_CHAT_BURST = float(os.environ.get("RATE_LIMIT_CHAT_BURST", "5"))  # messages a private chat may burst
+RATE_LIMIT_GROUP = float(os.environ.get("RATE_LIMIT_GROUP", "20"))  # messages/minute per group chat
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get("RATE_LIMIT_MAX_RETRIES", "3"))  # retries after a 429 RetryAfter
+
+# Incoming update throttling (button floods), checked before an update reaches a handler
+THROTTLE_USER_RATE = float(os.environ.get("THROTTLE_USER_RATE", "3"))  # updates/second per user
+THROTTLE_USER_BURST = float(os.environ.get("THROTTLE_USER_BURST", "10"))  # updates a user may burst
+THROTTLE_GLOBAL_RATE = float(os.environ.get("THROTTLE_GLOBAL_RATE", "300"))  # updates/second for the whole bot, 0 = unlimited
+THROTTLE_COALESCE_WINDOW = float(os.environ.get("THROTTLE_COALESCE_WINDOW", "0.5"))  # seconds; repeats of the same button are dropped
+THROTTLE_MAX_USERS = int(os.environ.get("THROTTLE_MAX_USERS", "10000"))  # users tracked; least recently seen are forgotten
+
+# Folder listing cache settings
+FOLDER_CACHE_SIZE = int(os.environ.get("FOLDER_CACHE_SIZE", "512"))  # number of cached listings
+FOLDER_CACHE_TTL = float(os.environ.get("FOLDER_CACHE_TTL", "300"))  # seconds
+FILE_CACHE_SIZE = int(os.environ.get("FILE_CACHE_SIZE", "2048"))  # number of cached file records
+
+# Activity log (downloads and folder opens) and cache prewarming
+ACTIVITY_FLUSH_SIZE = int(os.environ.get("ACTIVITY_FLUSH_SIZE", "200"))  # buffered events that trigger an early flush
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get("ACTIVITY_FLUSH_INTERVAL", "10"))  # seconds between flushes
+ACTIVITY_BUFFER_MAX = int(os.environ.get("ACTIVITY_BUFFER_MAX", "20000"))  # events kept while the database is unreachable
+ACTIVITY_WINDOW_DAYS = int(os.environ.get("ACTIVITY_WINDOW_DAYS", "30"))  # days the popularity aggregates look back
+ACTIVITY_RETENTION_DAYS = int(os.environ.get("ACTIVITY_RETENTION_DAYS", "180"))  # older events are deleted
+LECTURE_TIMEZONE = os.environ.get("LECTURE_TIMEZONE", "UTC")  # zone of peak hours and LECTURE_HOURS
+LECTURE_HOURS = sorted({int(hour) for hour in os.environ.get("LECTURE_HOURS", "").split(",") if hour.strip()})  # e.g. "8,10,14"
+PREWARM_FOLDERS = int(os.environ.get("PREWARM_FOLDERS", "20"))  # hottest folders loaded into the caches
+PREWARM_LEAD = float(os.environ.get("PREWARM_LEAD", "120"))  # seconds before a lecture hour; keep below FOLDER_CACHE_TTL
+
+# ===== METRICS =====
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+class Metrics:
+    """Minimal thread-safe registry of counters and latency histograms.
+
+    Rendered in the Prometheus text format. Values owned by other objects
+    (cache hits, reconnects, ...) are read at scrape time by collectors.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}  # name -> {label tuple: value}
+        self._histograms = {}  # name -> {label tuple: [bucket counts..., sum, count]}
+        self._collectors = []
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(labels.items())
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = tuple(labels.items())
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            data = series.get(key)
+            if data is None:
+                data = series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def count(self, name, **labels):
+        """Total number of observations of a histogram, across all labels or those matching `labels`"""
+        wanted = set(labels.items())
+        with self._lock:
+            return sum(data[-1] for key, data in self._histograms.get(name, {}).items() if wanted <= set(key))
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def add_collector(self, collect):
+        """Register a callable returning [(name, type, help, [(labels, value), ...]), ...]"""
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# HELP {name} {self._help.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{format_labels(dict(key))} {value}")
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# HELP {name} {self._help.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, data in series.items():
+                    labels = dict(key)
+                    for bound, count in zip(self.buckets, data):
+                        lines.append(f"{name}_bucket{format_labels({**labels, 'le': bound})} {count}")
+                    lines.append(f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {data[-1]}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {data[-2]}")
+                    lines.append(f"{name}_count{format_labels(labels)} {data[-1]}")
+        for collect in self._collectors:
+            try:
+                for name, kind, help_text, samples in collect():
+                    lines.append(f"# HELP {name} {help_text}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for labels, value in samples:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+            except Exception as e:
+                logger.error(f"❌ Error collecting metrics: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_db_query_seconds", "Time spent in DatabaseManager methods")
+metrics.describe("bot_handler_seconds", "Time spent handling an update, by handler and callback action")
+metrics.describe("bot_telegram_errors_total", "Failed Telegram Bot API calls by error type")
+metrics.describe("bot_snapshot_events_total", "Change notifications applied to the in-memory snapshot")
+metrics.describe("bot_snapshot_reloads_total", "Full reloads of the in-memory snapshot")
+metrics.describe("bot_prewarm_seconds", "Time spent loading the hottest folders into the caches")
+
+async def serve_metrics(reader, writer):
+    """Answer one HTTP request: GET /metrics returns the registry"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Drain the request headers
+        while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+# Startup milestones, in seconds since this module started loading
+STARTED_AT = time.monotonic()
+startup_timings = {}
+
+def mark_startup(stage):
+    """Record the first time a startup stage is reached"""
+    if stage not in startup_timings:
+        startup_timings[stage] = time.monotonic() - STARTED_AT
+        logger.info(f"⏱️ Startup: {stage} after {startup_timings[stage]:.2f}s")
+
+def instrumented(handler_name):
+    """Record a handler's latency; button presses are timed per route by CallbackRouter"""
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            with metrics.timer("bot_handler_seconds", handler=handler_name, action=""):
+                return await func(update, context)
+        return wrapper
+    return decorate
+
+# ===== PATH HELPERS =====
+def join_path(parent_path, name):
+    """Path of a child folder"""
+    if parent_path == '/':
+        return f"/{name}"
+    return f"{parent_path.rstrip('/')}/{name}"
+
+def is_same_or_descendant(path, root):
+    """True if path is root itself or lies somewhere below it"""
+    if root == '/':
+        return True
+    return path == root or path.startswith(root + '/')
+
+def escape_like(text):
+    """Escape LIKE metacharacters so text only matches itself"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def descendants_pattern(path):
+    """LIKE pattern matching strictly below path ('/Net' never matches '/Network')"""
+    return escape_like(path).rstrip('/') + '/%'
+
+# ===== CACHE =====
+
+class FolderCache:
+    """Thread-safe LRU cache of folder listings with a time-to-live.
+
+    Keys are (folder_path, page) tuples, with page None for a full listing, so
+    writes can invalidate exactly the listings of the folders they change.
+    Other caches pass `path_of` to say which folder an entry belongs to:
+    the file record cache is keyed by file id and reads the record's folder.
+    """
+
+    def __init__(self, maxsize=FOLDER_CACHE_SIZE, ttl=FOLDER_CACHE_TTL, path_of=lambda key, value: key[0]):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path_of = path_of
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # bumped on every invalidation
+        self._data = OrderedDict()  # (path, page) -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, generation=None):
+        """Store a listing; skipped if an invalidation ran since `generation` was read"""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, path):
+        """Drop every cached entry of a single folder"""
+        with self._lock:
+            self.generation += 1
+            for key in [key for key, entry in self._data.items() if self.path_of(key, entry[1]) == path]:
+                del self._data[key]
+
+    def invalidate_subtree(self, path):
+        """Drop the entries of a folder and of everything below it"""
+        with self._lock:
+            self.generation += 1
+            for key in [key for key, entry in self._data.items() if is_same_or_descendant(self.path_of(key, entry[1]), path)]:
+                del self._data[key]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            ratio = self.hits / total if total else 0.0
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'hit_ratio': ratio}
+
+# ===== TREE DOCUMENTS =====
+# Whole-library JSON: the legacy folders.json layout ({"subfolders": {...}})
+# with file entries carrying their file_id, type and size
+TREE_FORMAT = "lectures-tree"
+TREE_FORMAT_VERSION = 1
+
+def build_tree(folders, files):
+    """Nest (path, name, parent_path) folders and (filename, folder_path,
+    file_id, file_type, file_size, file_unique_id) files into a tree document"""
+    tree = {'format': TREE_FORMAT, 'version': TREE_FORMAT_VERSION, 'subfolders': {}, 'files': {}}
+    nodes = {'/': tree}
+    # Sorting by path puts every parent before its children
+    for path, name, parent_path in sorted(folders):
+        parent = nodes.get(parent_path)
+        if parent is None:
+            logger.warning(f"⚠️ Skipping folder without parent: {path}")
+            continue
+        nodes[path] = parent['subfolders'][name] = {'subfolders': {}, 'files': {}}
+    for filename, folder_path, file_id, file_type, file_size, file_unique_id in files:
+        node = nodes.get(folder_path)
+        if node is not None:
+            entry = node['files'][filename] = {'file_id': file_id, 'file_type': file_type, 'file_size': file_size or 0}
+            if file_unique_id:
+                entry['file_unique_id'] = file_unique_id
+    return tree
+
+def flatten_tree(tree):
+    """Turn a tree document into folder and file rows for import.
+
+    Accepts build_tree() output and the legacy layout, where a file may map
+    straight to its file_id. Folder rows are (path, name, parent_path) with
+    parents first; file rows are (filename, folder_path, file_id, file_type,
+    file_size, file_unique_id). Raises ValueError on malformed input.
+    """
+    if not isinstance(tree, dict):
+        raise ValueError("the document must be a JSON object")
+    folders, files = [], []
+    stack = [('/', tree)]
+    while stack:
+        path, node = stack.pop()
+        if not isinstance(node, dict):
+            raise ValueError(f"{path}: a folder must be a JSON object")
+        node_files, subfolders = node.get('files') or {}, node.get('subfolders') or {}
+        if not isinstance(node_files, dict) or not isinstance(subfolders, dict):
+            raise ValueError(f"{path}: files and subfolders must be JSON objects")
+        for filename, entry in node_files.items():
+            if isinstance(entry, str):
+                entry = {'file_id': entry}
+            if not filename or not isinstance(entry, dict) or not entry.get('file_id'):
+                raise ValueError(f"{join_path(path, filename)}: a file needs a name and a file_id")
+            try:
+                file_size = int(entry.get('file_size') or 0)
+            except (TypeError, ValueError, OverflowError):
+                raise ValueError(f"{join_path(path, filename)}: file_size must be a number")
+            files.append((filename, path, entry['file_id'], entry.get('file_type') or 'document',
+                          file_size, entry.get('file_unique_id')))
+        for name, child in subfolders.items():
+            if not name or '/' in name:
+                raise ValueError(f"{path}: invalid folder name {name!r}")
+            child_path = join_path(path, name)
+            folders.append((child_path, name, path))
+            stack.append((child_path, child))
+    return folders, files
+
+def parse_tree(data):
+    """Folder and file rows from the bytes or text of a tree document"""
+    return flatten_tree(json.loads(data))
+
 # ===== DATABASE SETUP =====
 class DatabaseManager:
     def __init__(self):
-        self.conn = None
+        self.pool = None
+        self.reconnects = 0
+        self._slots = threading.BoundedSemaphore(DB_POOL_MAX)
+        self._last_used = {}  # id(conn) -> monotonic time the connection was last known healthy
+        self.cache = FolderCache()
+        self.file_cache = FolderCache(maxsize=FILE_CACHE_SIZE, path_of=lambda key, record: record['folder_path'])  # file id -> get_file() record
+        self.has_trgm = False
         self.connect()
-        self.create_tables()
+        self.migrate()
 
     def connect(self):
-        """Connect to PostgreSQL database"""
+        """Create the PostgreSQL connection pool"""
         try:
             # Railway/Render require SSL
-            self.conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-            self.conn.autocommit = True  # Auto-commit for better reliability
-            logger.info("✅ Connected to PostgreSQL database")
+            self.pool = self._create_pool(sslmode='require')
+            self.connect_kwargs = {'sslmode': 'require'}
+            logger.info(f"✅ Connected to PostgreSQL database (pool {DB_POOL_MIN}-{DB_POOL_MAX})")
         except Exception as e:
             logger.error(f"❌ Database connection error: {e}")
             # Fallback: try without SSL for local development
             try:
-                self.conn = psycopg2.connect(DATABASE_URL)
-                self.conn.autocommit = True
-                logger.info("✅ Connected to PostgreSQL database (no SSL)")
+                self.pool = self._create_pool()
+                self.connect_kwargs = {}
+                logger.info(f"✅ Connected to PostgreSQL database (no SSL, pool {DB_POOL_MIN}-{DB_POOL_MAX})")
             except Exception as e2:
                 logger.error(f"❌ Database connection failed completely: {e2}")
                 raise
 
-    def create_tables(self):
-        """Create tables if they don't exist"""
+    def _create_pool(self, **kwargs):
+        return ThreadedConnectionPool(
+            DB_POOL_MIN,
+            DB_POOL_MAX,
+            DATABASE_URL,
+            connect_timeout=DB_CONNECT_TIMEOUT,
+            options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT}",
+            **kwargs
+        )
+
+    def _is_healthy(self, conn):
+        """Pre-ping connections that have been idle for a while"""
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < DB_PING_INTERVAL:
+            return True
+        try:
+            conn.autocommit = True  # Auto-commit for better reliability
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        """Take a healthy connection from the pool, reconnecting with backoff"""
+        if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+            raise PoolError("Timed out waiting for a free database connection")
+
+        delay = DB_RETRY_BACKOFF
+        attempt = 0
+        try:
+            while True:
+                try:
+                    conn = self.pool.getconn()
+                    if self._is_healthy(conn):
+                        return conn
+                    # Stale connection: throw it away and try the next one straight away
+                    self._last_used.pop(id(conn), None)
+                    self.pool.putconn(conn, close=True)
+                    self.reconnects += 1
+                    logger.warning("⚠️ Dropped stale database connection, reconnecting")
+                except psycopg2.OperationalError as e:
+                    attempt += 1
+                    if attempt >= DB_RETRY_ATTEMPTS:
+                        logger.error(f"❌ Database unreachable after {attempt} attempts: {e}")
+                        raise
+                    logger.warning(f"⚠️ Database connect attempt {attempt} failed, retrying in {delay:.1f}s: {e}")
+                    time.sleep(delay)
+                    delay = min(delay * 2, DB_RETRY_BACKOFF_MAX)
+        except BaseException:
+            # No connection is handed out, so nobody else will return the slot
+            self._slots.release()
+            raise
+
+    def _release(self, conn, broken=False):
+        try:
+            if broken or conn.closed:
+                self._last_used.pop(id(conn), None)
+                self.pool.putconn(conn, close=True)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self.pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def _cursor(self, cursor_factory=None):
+        """Borrow a pooled connection for the duration of one cursor"""
+        conn = self._checkout()
+        broken = False
+        try:
+            with conn.cursor(cursor_factory=cursor_factory) as cur:
+                yield cur
+        except psycopg2.errors.QueryCanceled:
+            # statement_timeout fired: the query was slow, the connection is fine
+            raise
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # The server went away: drop this connection and make every other
+            # pooled connection prove it is alive before it is used again
+            broken = True
+            self._last_used.clear()
+            raise
+        finally:
+            self._release(conn, broken)
+
+    @contextmanager
+    def _transaction(self):
+        """Borrow a pooled connection and run the block as one transaction"""
+        with self._cursor() as cur:
+            conn = cur.connection
+            conn.autocommit = False
+            try:
+                with conn:  # commit on success, roll back on error
+                    yield cur
+            finally:
+                if not conn.closed:
+                    conn.autocommit = True
+
+    def migrate(self):
+        """Bring the schema up to the latest version in MIGRATIONS.
+
+        Applied versions are recorded in schema_version, so starting against
+        an up-to-date database runs no DDL at all. Pending migrations run in
+        one transaction under an advisory lock, so replicas starting together
+        apply each of them once.
+        """
+        latest = self.MIGRATIONS[-1][0]
         try:
-            with self.conn.cursor() as cur:
-                # Table for folder structure
+            with self._cursor() as cur:
                 cur.execute('''
-                    CREATE TABLE IF NOT EXISTS folders (
-                        id SERIAL PRIMARY KEY,
-                        path TEXT UNIQUE NOT NULL,
-                        name TEXT NOT NULL,
-                        parent_path TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
+                    SELECT to_regclass('schema_version') IS NOT NULL,
+                           EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')
                 ''')
-                
-                # Table for files
+                has_versions, self.has_trgm = cur.fetchone()
+                version = self._schema_version(cur) if has_versions else 0
+            if version >= latest:
+                logger.info(f"✅ Database schema up to date (version {version})")
+                return
+            
+            with self._transaction() as cur:
+                cur.execute('SELECT pg_advisory_xact_lock(%s)', (self.MIGRATION_LOCK_ID,))
                 cur.execute('''
-                    CREATE TABLE IF NOT EXISTS files (
-                        id SERIAL PRIMARY KEY,
-                        filename TEXT NOT NULL,
-                        folder_path TEXT NOT NULL,
-                        file_id TEXT NOT NULL,
-                        file_type TEXT DEFAULT 'document',
-                        file_size BIGINT DEFAULT 0,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        UNIQUE(filename, folder_path)
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT NOT NULL,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 ''')
-                
-                # Create indexes for better performance
-                cur.execute('CREATE INDEX IF NOT EXISTS idx_folders_parent_path ON folders(parent_path)')
-                cur.execute('CREATE INDEX IF NOT EXISTS idx_files_folder_path ON files(folder_path)')
-                
-                # Create root folder if it doesn't exist
-                cur.execute('''
-                    INSERT INTO folders (path, name, parent_path) 
-                    VALUES ('/', 'Root', NULL) 
-                    ON CONFLICT (path) DO NOTHING
-                ''')
-                
-                logger.info("✅ Database tables created/verified successfully")
+                # Another replica may have migrated while we waited for the lock
+                version = self._schema_version(cur)
+                for number, description, migration in self.MIGRATIONS:
+                    if number > version:
+                        migration(self, cur)
+                        cur.execute(
+                            'INSERT INTO schema_version (version, description) VALUES (%s, %s)',
+                            (number, description)
+                        )
+                        logger.info(f"✅ Applied migration {number}: {description}")
+            logger.info(f"✅ Database schema migrated to version {latest}")
         except Exception as e:
-            logger.error(f"❌ Error creating tables: {e}")
+            logger.error(f"❌ Error migrating database: {e}")
             raise
 
+    def _schema_version(self, cur):
+        cur.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+        return cur.fetchone()[0]
+
+    # Each migration is idempotent, so a database created before schema_version
+    # existed simply replays them once.
+    def create_base_tables(self, cur):
+        """Folders and files tables with their lookup indexes and the root folder"""
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS folders (
+                id SERIAL PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                name TEXT NOT NULL,
+                parent_path TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                id SERIAL PRIMARY KEY,
+                filename TEXT NOT NULL,
+                folder_path TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                file_type TEXT DEFAULT 'document',
+                file_size BIGINT DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(filename, folder_path)
+            )
+        ''')
+        
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_folders_parent_path ON folders(parent_path)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_files_folder_path ON files(folder_path)')
+        
+        cur.execute('''
+            INSERT INTO folders (path, name, parent_path) 
+            VALUES ('/', 'Root', NULL) 
+            ON CONFLICT (path) DO NOTHING
+        ''')
+
+    def create_prefix_indexes(self, cur):
+        """Prefix indexes so subtree LIKE 'path/%' scans work under any collation"""
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_folders_path_prefix ON folders(path text_pattern_ops)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_files_folder_path_prefix ON files(folder_path text_pattern_ops)')
+
+    def create_session_table(self, cur):
+        """Per-user navigation state, written behind by SessionStore"""
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS user_sessions (
+                user_id BIGINT PRIMARY KEY,
+                path TEXT NOT NULL DEFAULT '/',
+                upload_path TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+    def create_search_indexes(self, cur):
+        """Trigram indexes for fuzzy search, when pg_trgm can be installed"""
+        # A failed CREATE EXTENSION must not abort the whole migration transaction
+        cur.execute('SAVEPOINT pg_trgm')
+        try:
+            cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cur.execute('RELEASE SAVEPOINT pg_trgm')
+        except psycopg2.Error as e:
+            cur.execute('ROLLBACK TO SAVEPOINT pg_trgm')
+            logger.warning(f"⚠️ pg_trgm unavailable, search falls back to substring matching: {e}")
+        
+        cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+        self.has_trgm = cur.fetchone()[0]
+        if self.has_trgm:
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_files_filename_trgm ON files USING gin (filename gin_trgm_ops)')
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_folders_name_trgm ON folders USING gin (name gin_trgm_ops)')
+
+    def create_stats_tables(self, cur):
+        """Create trigger-maintained recursive totals per folder.
+
+        folder_stats holds, for every folder, the number of files, their total
+        size and the number of folders anywhere below it; the '/' row holds the
+        library totals. Triggers on files and folders keep it up to date;
+        subtree operations switch them off with lectures.bulk_write and apply
+        one aggregated delta instead.
+        """
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS folder_stats (
+                path TEXT PRIMARY KEY,
+                file_count BIGINT NOT NULL DEFAULT 0,
+                total_size BIGINT NOT NULL DEFAULT 0,
+                folder_count BIGINT NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        # Apply a delta to a folder and all of its ancestors. Increments create
+        # missing rows; decrements only touch rows that exist, so deleting a
+        # subtree never resurrects the rows of folders that are already gone.
+        cur.execute('''
+            CREATE OR REPLACE FUNCTION bump_folder_stats(
+                p_path TEXT, d_files BIGINT, d_size BIGINT, d_folders BIGINT
+            ) RETURNS void AS $$
+            DECLARE
+                anc TEXT := p_path;
+            BEGIN
+                WHILE anc IS NOT NULL LOOP
+                    IF d_files >= 0 AND d_size >= 0 AND d_folders >= 0 THEN
+                        INSERT INTO folder_stats (path, file_count, total_size, folder_count)
+                        VALUES (anc, d_files, d_size, d_folders)
+                        ON CONFLICT (path) DO UPDATE SET
+                            file_count = folder_stats.file_count + EXCLUDED.file_count,
+                            total_size = folder_stats.total_size + EXCLUDED.total_size,
+                            folder_count = folder_stats.folder_count + EXCLUDED.folder_count;
+                    ELSE
+                        UPDATE folder_stats SET
+                            file_count = file_count + d_files,
+                            total_size = total_size + d_size,
+                            folder_count = folder_count + d_folders
+                        WHERE path = anc;
+                    END IF;
+                    
+                    IF anc = '/' THEN
+                        anc := NULL;
+                    ELSE
+                        anc := COALESCE(NULLIF(regexp_replace(anc, '/[^/]*$', ''), ''), '/');
+                    END IF;
+                END LOOP;
+            END
+            $$ LANGUAGE plpgsql
+        ''')
+        
+        cur.execute('''
+            CREATE OR REPLACE FUNCTION files_stats_trigger() RETURNS trigger AS $$
+            BEGIN
+                -- Subtree operations adjust the totals themselves
+                IF current_setting('lectures.bulk_write', true) = 'on' THEN
+                    RETURN NULL;
+                END IF;
+                IF TG_OP = 'UPDATE' AND NEW.folder_path = OLD.folder_path
+                        AND NEW.file_size IS NOT DISTINCT FROM OLD.file_size THEN
+                    RETURN NULL;
+                END IF;
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    PERFORM bump_folder_stats(OLD.folder_path, -1, -COALESCE(OLD.file_size, 0), 0);
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    PERFORM bump_folder_stats(NEW.folder_path, 1, COALESCE(NEW.file_size, 0), 0);
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        ''')
+        
+        cur.execute('''
+            CREATE OR REPLACE FUNCTION folders_stats_trigger() RETURNS trigger AS $$
+            BEGIN
+                IF current_setting('lectures.bulk_write', true) = 'on' THEN
+                    RETURN NULL;
+                END IF;
+                IF TG_OP = 'INSERT' AND NEW.parent_path IS NOT NULL THEN
+                    PERFORM bump_folder_stats(NEW.parent_path, 0, 0, 1);
+                ELSIF TG_OP = 'DELETE' THEN
+                    DELETE FROM folder_stats WHERE path = OLD.path;
+                    IF OLD.parent_path IS NOT NULL THEN
+                        PERFORM bump_folder_stats(OLD.parent_path, 0, 0, -1);
+                    END IF;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        ''')
+        
+        cur.execute('DROP TRIGGER IF EXISTS trg_files_stats ON files')
+        cur.execute('''
+            CREATE TRIGGER trg_files_stats
+            AFTER INSERT OR UPDATE OR DELETE ON files
+            FOR EACH ROW EXECUTE FUNCTION files_stats_trigger()
+        ''')
+        cur.execute('DROP TRIGGER IF EXISTS trg_folders_stats ON folders')
+        cur.execute('''
+            CREATE TRIGGER trg_folders_stats
+            AFTER INSERT OR DELETE ON folders
+            FOR EACH ROW EXECUTE FUNCTION folders_stats_trigger()
+        ''')
+        
+        # Backfill once from existing data, e.g. the first start after upgrading
+        cur.execute('SELECT EXISTS (SELECT 1 FROM folder_stats)')
+        if not cur.fetchone()[0]:
+            self.rebuild_folder_stats(cur)
+
+    def create_notify_triggers(self, cur):
+        """Announce every folder and file change on SNAPSHOT_CHANNEL.
+
+        Each notification carries the whole row, so listeners can apply it
+        without a query. Subtree operations run with lectures.bulk_write and
+        send a single RELOAD instead of one notification per row.
+        """
+        cur.execute(f'''
+            CREATE OR REPLACE FUNCTION notify_lectures_change() RETURNS trigger AS $$
+            BEGIN
+                IF current_setting('lectures.bulk_write', true) = 'on' THEN
+                    RETURN NULL;
+                END IF;
+                PERFORM pg_notify('{SNAPSHOT_CHANNEL}', json_build_object(
+                    'op', TG_OP,
+                    'table', TG_TABLE_NAME,
+                    'row', row_to_json(CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END)
+                )::text);
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        ''')
+        for table in ('folders', 'files'):
+            cur.execute(f'DROP TRIGGER IF EXISTS trg_{table}_notify ON {table}')
+            cur.execute(f'''
+                CREATE TRIGGER trg_{table}_notify
+                AFTER INSERT OR UPDATE OR DELETE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION notify_lectures_change()
+            ''')
+
+    def create_content_index(self, cur):
+        """Record file_unique_id and keep one row per distinct stored content.
+
+        file_contents counts how many files rows share a content, keyed by
+        file_unique_id (or file_id for rows stored before it was recorded),
+        so the deduplicated library size is a sum over distinct contents.
+        Unlike folder_stats it is maintained for bulk writes too.
+        """
+        cur.execute('ALTER TABLE files ADD COLUMN IF NOT EXISTS file_unique_id TEXT')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_files_unique_id ON files(file_unique_id)')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS file_contents (
+                content_key TEXT PRIMARY KEY,
+                file_size BIGINT NOT NULL DEFAULT 0,
+                refs INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cur.execute('''
+            CREATE OR REPLACE FUNCTION files_content_trigger() RETURNS trigger AS $$
+            DECLARE
+                old_key TEXT;
+                new_key TEXT;
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    old_key := COALESCE(OLD.file_unique_id, OLD.file_id);
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    new_key := COALESCE(NEW.file_unique_id, NEW.file_id);
+                END IF;
+                IF old_key IS NOT DISTINCT FROM new_key THEN
+                    RETURN NULL;
+                END IF;
+                IF old_key IS NOT NULL THEN
+                    UPDATE file_contents SET refs = refs - 1 WHERE content_key = old_key;
+                    DELETE FROM file_contents WHERE content_key = old_key AND refs <= 0;
+                END IF;
+                IF new_key IS NOT NULL THEN
+                    INSERT INTO file_contents (content_key, file_size, refs)
+                    VALUES (new_key, COALESCE(NEW.file_size, 0), 1)
+                    ON CONFLICT (content_key) DO UPDATE SET refs = file_contents.refs + 1;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        ''')
+        cur.execute('DROP TRIGGER IF EXISTS trg_files_content ON files')
+        cur.execute('''
+            CREATE TRIGGER trg_files_content
+            AFTER INSERT OR UPDATE OR DELETE ON files
+            FOR EACH ROW EXECUTE FUNCTION files_content_trigger()
+        ''')
+        cur.execute('DELETE FROM file_contents')
+        cur.execute('''
+            INSERT INTO file_contents (content_key, file_size, refs)
+            SELECT COALESCE(file_unique_id, file_id), MAX(COALESCE(file_size, 0)), COUNT(*)
+            FROM files GROUP BY 1
+        ''')
+
+    def create_activity_table(self, cur):
+        """Downloads and folder opens, appended in batches by ActivityLog"""
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS activity (
+                id BIGSERIAL PRIMARY KEY,
+                kind TEXT NOT NULL,
+                user_id BIGINT,
+                folder_path TEXT NOT NULL,
+                file_pk INTEGER,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_activity_created_at ON activity(created_at)')
+
+    NOTIFY_TABLES = ('folders', 'files')
+
+    def disable_notify_triggers(self, cur):
+        """Leave the change notification triggers off until a snapshot needs them.
+
+        Every pg_notify serialises its commit on a cluster-wide lock, which
+        deployments without SNAPSHOT_MODE paid on each write for nobody.
+        SnapshotDatabaseManager switches the triggers back on at startup.
+        """
+        for table in self.NOTIFY_TABLES:
+            cur.execute(f'ALTER TABLE {table} DISABLE TRIGGER trg_{table}_notify')
+
+    MIGRATION_LOCK_ID = 0x6C656374  # pg_advisory_xact_lock key held while migrating
+    # (version, description, method); append new migrations, never edit applied ones
+    MIGRATIONS = [
+        (1, "folders and files tables", create_base_tables),
+        (2, "prefix indexes for subtree queries", create_prefix_indexes),
+        (3, "trigram search indexes", create_search_indexes),
+        (4, "user sessions table", create_session_table),
+        (5, "trigger-maintained folder statistics", create_stats_tables),
+        (6, "change notifications for snapshots", create_notify_triggers),
+        (7, "file_unique_id and deduplicated sizes", create_content_index),
+        (8, "download and folder activity log", create_activity_table),
+        (9, "change notifications only for snapshots", disable_notify_triggers),
+    ]
+
+    def notify_reload(self, cur):
+        """Tell snapshot listeners to reload the whole tree once this transaction commits"""
+        cur.execute('SELECT pg_notify(%s, %s)', (SNAPSHOT_CHANNEL, json.dumps({'op': 'RELOAD'})))
+
+    def rebuild_folder_stats(self, cur):
+        """Recompute folder_stats from scratch.
+
+        Per-folder totals are grouped first and then credited to every
+        ancestor of the folder, which keeps a rebuild linear in the size of
+        the library.
+        """
+        ancestors = '''
+            CROSS JOIN LATERAL (
+                SELECT '/' || array_to_string(p.parts[1:i], '/') AS path
+                FROM (SELECT string_to_array(ltrim({col}, '/'), '/') AS parts) p,
+                     generate_series(0, cardinality(p.parts)) i
+            ) a
+        '''
+        cur.execute('DELETE FROM folder_stats')
+        cur.execute(f'''
+            INSERT INTO folder_stats (path, file_count, total_size, folder_count)
+            SELECT f.path, COALESCE(fs.file_count, 0), COALESCE(fs.total_size, 0), COALESCE(ds.folder_count, 0)
+            FROM folders f
+            LEFT JOIN (
+                SELECT a.path, SUM(d.file_count) AS file_count, SUM(d.total_size) AS total_size
+                FROM (
+                    SELECT folder_path, COUNT(*) AS file_count, COALESCE(SUM(file_size), 0) AS total_size
+                    FROM files GROUP BY folder_path
+                ) d
+                {ancestors.format(col='d.folder_path')}
+                GROUP BY a.path
+            ) fs ON fs.path = f.path
+            LEFT JOIN (
+                SELECT a.path, COUNT(*) AS folder_count
+                FROM folders d
+                {ancestors.format(col='d.parent_path')}
+                WHERE d.parent_path IS NOT NULL
+                GROUP BY a.path
+            ) ds ON ds.path = f.path
+        ''')
+        logger.info("✅ Folder statistics rebuilt")
+
     def get_folder_structure(self, path='/'):
-        """Get folder structure from database"""
+        """Get folder structure, served from the listing cache when possible.
+
+        Maps subfolder names to folders.id and filenames to files.id. The
+        returned dict is shared with the cache and must not be modified.
+        """
+        key = (path, None)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        generation = self.cache.generation
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-                # Get subfolders
+            with self._cursor() as cur:
+                # One round trip: folders (kind 0) and files (kind 1) in a single result
                 cur.execute('''
-                    SELECT name FROM folders 
-                    WHERE parent_path = %s 
-                    ORDER BY name
-                ''', (path,))
-                subfolders = {row['name']: {} for row in cur.fetchall()}
+                    SELECT 0 AS kind, name, id FROM folders
+                    WHERE parent_path = %s
+                    UNION ALL
+                    SELECT 1 AS kind, filename, id FROM files
+                    WHERE folder_path = %s
+                    ORDER BY kind, name
+                ''', (path, path))
                 
-                # Get files
-                cur.execute('''
-                    SELECT filename, file_id FROM files 
-                    WHERE folder_path = %s 
-                    ORDER BY filename
-                ''', (path,))
-                files = {row['filename']: row['file_id'] for row in cur.fetchall()}
+                subfolders = {}
+                files = {}
+                for kind, name, row_id in cur.fetchall():
+                    if kind == 0:
+                        subfolders[name] = row_id
+                    else:
+                        files[name] = row_id
                 
-                return {
+                structure = {
                     'subfolders': subfolders,
                     'files': files
                 }
+                self.cache.put(key, structure, generation)
+                return structure
         except Exception as e:
             logger.error(f"❌ Error getting folder structure: {e}")
             return {'subfolders': {}, 'files': {}}
 
+    def get_folder_page(self, path='/', page=0, page_size=FOLDER_PAGE_SIZE, kind=None):
+        """Get one page of a folder listing: subfolders first, then files.
+
+        Fetches one row more than the page size to know whether a next page
+        exists without counting the whole folder. 'has_files' says whether
+        the folder holds any files at all, even when subfolders fill this page.
+        `kind` ('subfolders' or 'files') pages through only one of the two.
+        """
+        key = (path, page) if kind is None else (path, page, kind)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        generation = self.cache.generation
+        parts = []
+        if kind != 'files':
+            parts.append('SELECT 0 AS kind, name, id FROM folders WHERE parent_path = %(path)s')
+        if kind != 'subfolders':
+            parts.append('SELECT 1 AS kind, filename AS name, id FROM files WHERE folder_path = %(path)s')
+        try:
+            with self._cursor() as cur:
+                cur.execute(f'''
+                    {' UNION ALL '.join(parts)}
+                    ORDER BY kind, name
+                    LIMIT %(limit)s OFFSET %(offset)s
+                ''', {'path': path, 'limit': page_size + 1, 'offset': page * page_size})
+                rows = cur.fetchall()
+                
+                subfolders = {}
+                files = {}
+                for kind, name, row_id in rows[:page_size]:
+                    if kind == 0:
+                        subfolders[name] = row_id
+                    else:
+                        files[name] = row_id
+                
+                # Files sort after subfolders: only a last row that is a folder leaves this open
+                has_files = any(kind == 1 for kind, _, _ in rows)
+                if not has_files and len(rows) > page_size and kind is None:
+                    cur.execute('SELECT EXISTS (SELECT 1 FROM files WHERE folder_path = %s)', (path,))
+                    has_files = cur.fetchone()[0]
+                
+                listing = {
+                    'subfolders': subfolders,
+                    'files': files,
+                    'page': page,
+                    'has_next': len(rows) > page_size,
+                    'has_files': has_files
+                }
+                self.cache.put(key, listing, generation)
+                return listing
+        except Exception as e:
+            logger.error(f"❌ Error getting folder page: {e}")
+            return {'subfolders': {}, 'files': {}, 'page': page, 'has_next': False, 'has_files': False}
+
     def create_folder(self, parent_path, folder_name):
         """Create a new folder"""
         try:
-            new_path = f"{parent_path.rstrip('/')}/{folder_name}"
-            if parent_path == '/':
-                new_path = f"/{folder_name}"
+            new_path = join_path(parent_path, folder_name)
                 
-            with self.conn.cursor() as cur:
+            with self._cursor() as cur:
                 cur.execute('''
                     INSERT INTO folders (path, name, parent_path) 
                     VALUES (%s, %s, %s)
                 ''', (new_path, folder_name, parent_path))
+                self.cache.invalidate(parent_path)
                 logger.info(f"✅ Created folder: {new_path}")
                 return True
         except psycopg2.IntegrityError:
@@ -157,137 +1112,1264 @@ class DatabaseManager:
             return False
 
     def delete_folder(self, parent_path, folder_name):
-        """Delete a folder and all its contents"""
+        """Delete a folder and all its contents in one transaction"""
         try:
-            folder_path = f"{parent_path.rstrip('/')}/{folder_name}"
-            if parent_path == '/':
-                folder_path = f"/{folder_name}"
+            folder_path = join_path(parent_path, folder_name)
+            pattern = descendants_pattern(folder_path)
+                
+            with self._transaction() as cur:
+                cur.execute("SET LOCAL lectures.bulk_write = 'on'")
                 
-            with self.conn.cursor() as cur:
                 # Delete all files in this folder and subfolders
                 cur.execute('''
-                    DELETE FROM files 
-                    WHERE folder_path LIKE %s
-                ''', (f"{folder_path}%",))
+                    WITH gone AS (
+                        DELETE FROM files 
+                        WHERE folder_path = %s OR folder_path LIKE %s
+                        RETURNING file_size
+                    )
+                    SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM gone
+                ''', (folder_path, pattern))
+                file_count, total_size = cur.fetchone()
                 
-                # Delete all subfolders
+                # Delete the folder and all subfolders
                 cur.execute('''
-                    DELETE FROM folders 
-                    WHERE path LIKE %s
-                ''', (f"{folder_path}%",))
+                    WITH gone AS (
+                        DELETE FROM folders 
+                        WHERE path = %s OR path LIKE %s
+                        RETURNING 1
+                    )
+                    SELECT COUNT(*) FROM gone
+                ''', (folder_path, pattern))
+                folder_count = cur.fetchone()[0]
+                if not folder_count:
+                    return False
                 
-                logger.info(f"✅ Deleted folder and contents: {folder_path}")
-                return True
+                cur.execute('''
+                    DELETE FROM folder_stats 
+                    WHERE path = %s OR path LIKE %s
+                ''', (folder_path, pattern))
+                
+                cur.execute("SET LOCAL lectures.bulk_write = 'off'")
+                cur.execute(
+                    'SELECT bump_folder_stats(%s, %s, %s, %s)',
+                    (parent_path, -file_count, -total_size, -folder_count)
+                )
+                self.notify_reload(cur)
+                
+            # The parent loses a subfolder, everything below it disappears
+            self.cache.invalidate(parent_path)
+            self.cache.invalidate_subtree(folder_path)
+            self.file_cache.invalidate_subtree(folder_path)
+            logger.info(f"✅ Deleted folder and contents: {folder_path} ({folder_count} folders, {file_count} files)")
+            return True
         except Exception as e:
             logger.error(f"❌ Error deleting folder: {e}")
             return False
 
-    def add_file(self, folder_path, filename, file_id, file_type='document', file_size=0):
-        """Add a file to the database"""
+    def move_folder(self, folder_id, new_parent_path):
+        """Move a folder and everything below it under another folder in one transaction"""
         try:
-            with self.conn.cursor() as cur:
+            with self._transaction() as cur:
+                cur.execute('''
+                    SELECT path, name, parent_path FROM folders 
+                    WHERE id = %s 
+                    FOR UPDATE
+                ''', (folder_id,))
+                result = cur.fetchone()
+                if not result or result[0] == '/':
+                    logger.warning(f"⚠️ Folder to move not found: {folder_id}")
+                    return False
+                
+                old_path, name, old_parent = result
+                new_path = join_path(new_parent_path, name)
+                if is_same_or_descendant(new_parent_path, old_path) or new_parent_path == old_parent:
+                    logger.warning(f"⚠️ Cannot move {old_path} into {new_parent_path}")
+                    return False
+                
+                cur.execute('SELECT EXISTS (SELECT 1 FROM folders WHERE path = %s)', (new_parent_path,))
+                if not cur.fetchone()[0]:
+                    logger.warning(f"⚠️ Destination folder not found: {new_parent_path}")
+                    return False
+                
+                cur.execute("SET LOCAL lectures.bulk_write = 'on'")
+                pattern = descendants_pattern(old_path)
+                
+                cur.execute('''
+                    WITH moved AS (
+                        UPDATE folders SET 
+                            path = %(new)s || substr(path, length(%(old)s) + 1),
+                            parent_path = CASE WHEN path = %(old)s THEN %(parent)s
+                                ELSE %(new)s || substr(parent_path, length(%(old)s) + 1) END
+                        WHERE path = %(old)s OR path LIKE %(pattern)s
+                        RETURNING 1
+                    )
+                    SELECT COUNT(*) FROM moved
+                ''', {'new': new_path, 'old': old_path, 'parent': new_parent_path, 'pattern': pattern})
+                folder_count = cur.fetchone()[0]
+                
+                cur.execute('''
+                    WITH moved AS (
+                        UPDATE files SET folder_path = %(new)s || substr(folder_path, length(%(old)s) + 1)
+                        WHERE folder_path = %(old)s OR folder_path LIKE %(pattern)s
+                        RETURNING file_size
+                    )
+                    SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM moved
+                ''', {'new': new_path, 'old': old_path, 'pattern': pattern})
+                file_count, total_size = cur.fetchone()
+                
                 cur.execute('''
-                    INSERT INTO files (filename, folder_path, file_id, file_type, file_size) 
-                    VALUES (%s, %s, %s, %s, %s)
+                    UPDATE folder_stats SET path = %(new)s || substr(path, length(%(old)s) + 1)
+                    WHERE path = %(old)s OR path LIKE %(pattern)s
+                ''', {'new': new_path, 'old': old_path, 'pattern': pattern})
+                
+                cur.execute("SET LOCAL lectures.bulk_write = 'off'")
+                cur.execute(
+                    'SELECT bump_folder_stats(%s, %s, %s, %s)',
+                    (old_parent, -file_count, -total_size, -folder_count)
+                )
+                cur.execute(
+                    'SELECT bump_folder_stats(%s, %s, %s, %s)',
+                    (new_parent_path, file_count, total_size, folder_count)
+                )
+                self.notify_reload(cur)
+                
+            self.cache.invalidate(old_parent)
+            self.cache.invalidate(new_parent_path)
+            self.cache.invalidate_subtree(old_path)
+            self.cache.invalidate_subtree(new_path)
+            self.file_cache.invalidate_subtree(old_path)
+            logger.info(f"✅ Moved folder: {old_path} -> {new_path}")
+            return True
+        except psycopg2.IntegrityError:
+            logger.warning(f"⚠️ Folder already exists at destination: {new_parent_path}")
+            return False
+        except Exception as e:
+            logger.error(f"❌ Error moving folder: {e}")
+            return False
+
+    def add_file(self, folder_path, filename, file_id, file_type='document', file_size=0, file_unique_id=None):
+        """Add a file to the database"""
+        return self.add_files(folder_path, [(filename, file_id, file_type, file_size, file_unique_id)])
+
+    def add_files(self, folder_path, files):
+        """Add many (filename, file_id, file_type, file_size, file_unique_id) rows in one statement.
+
+        A file whose content is already stored in this folder under another
+        name is skipped; the same name is overwritten as before.
+        """
+        try:
+            with self._cursor() as cur:
+                execute_values(cur, '''
+                    INSERT INTO files (filename, folder_path, file_id, file_type, file_size, file_unique_id) 
+                    SELECT v.filename, v.folder_path, v.file_id, v.file_type, v.file_size::BIGINT, v.file_unique_id
+                    FROM (VALUES %s) AS v (filename, folder_path, file_id, file_type, file_size, file_unique_id)
+                    WHERE v.file_unique_id IS NULL OR NOT EXISTS (
+                        SELECT 1 FROM files f 
+                        WHERE f.file_unique_id = v.file_unique_id 
+                          AND f.folder_path = v.folder_path 
+                          AND f.filename <> v.filename
+                    )
                     ON CONFLICT (filename, folder_path) 
                     DO UPDATE SET 
                         file_id = EXCLUDED.file_id, 
                         file_type = EXCLUDED.file_type,
                         file_size = EXCLUDED.file_size,
+                        file_unique_id = EXCLUDED.file_unique_id,
                         created_at = CURRENT_TIMESTAMP
-                ''', (filename, folder_path, file_id, file_type, file_size))
-                logger.info(f"✅ Added file: {filename} to {folder_path}")
+                ''', [(filename, folder_path, file_id, file_type, file_size, file_unique_id)
+                      for filename, file_id, file_type, file_size, file_unique_id in files])
+                self.cache.invalidate(folder_path)
+                self.file_cache.invalidate(folder_path)
+                if len(files) == 1:
+                    logger.info(f"✅ Added file: {files[0][0]} to {folder_path}")
+                else:
+                    logger.info(f"✅ Added {len(files)} files to {folder_path}")
                 return True
         except Exception as e:
-            logger.error(f"❌ Error adding file: {e}")
+            logger.error(f"❌ Error adding files: {e}")
             return False
 
+    def find_copies(self, file_unique_ids):
+        """Where contents are already stored: {file_unique_id: [(folder_path, filename), ...]}"""
+        copies = {}
+        if not file_unique_ids:
+            return copies
+        try:
+            with self._cursor() as cur:
+                cur.execute('''
+                    SELECT file_unique_id, folder_path, filename FROM files 
+                    WHERE file_unique_id = ANY(%s) 
+                    ORDER BY folder_path, filename
+                ''', (list(file_unique_ids),))
+                for file_unique_id, folder_path, filename in cur.fetchall():
+                    copies.setdefault(file_unique_id, []).append((folder_path, filename))
+        except Exception as e:
+            logger.error(f"❌ Error looking up existing copies: {e}")
+        return copies
+
     def delete_file(self, folder_path, filename):
         """Delete a file"""
         try:
-            with self.conn.cursor() as cur:
+            with self._cursor() as cur:
                 cur.execute('''
                     DELETE FROM files 
                     WHERE filename = %s AND folder_path = %s
                 ''', (filename, folder_path))
+                self.cache.invalidate(folder_path)
+                self.file_cache.invalidate(folder_path)
                 logger.info(f"✅ Deleted file: {filename} from {folder_path}")
                 return True
         except Exception as e:
             logger.error(f"❌ Error deleting file: {e}")
             return False
 
-    def get_file_id(self, folder_path, filename):
-        """Get file ID for download"""
+    def export_tree(self):
+        """The whole library as a tree document, read from one consistent snapshot"""
+        try:
+            with self._transaction() as cur:
+                cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+                cur.execute("SELECT path, name, parent_path FROM folders WHERE path <> '/'")
+                folders = cur.fetchall()
+                cur.execute('SELECT filename, folder_path, file_id, file_type, file_size, file_unique_id FROM files')
+                files = cur.fetchall()
+            return build_tree(folders, files)
+        except Exception as e:
+            logger.error(f"❌ Error exporting tree: {e}")
+            return None
+
+    def import_tree(self, folders, files, replace=False):
+        """Load flatten_tree() rows in one transaction.
+
+        Existing folders are kept and a file with the same name in the same
+        folder is overwritten; replace=True empties the library first. Row
+        triggers are switched off and folder_stats is rebuilt once at the end.
+        """
+        try:
+            with self._transaction() as cur:
+                cur.execute("SET LOCAL lectures.bulk_write = 'on'")
+                if replace:
+                    cur.execute('DELETE FROM files')
+                    cur.execute("DELETE FROM folders WHERE path <> '/'")
+                
+                execute_values(cur, '''
+                    INSERT INTO folders (path, name, parent_path) 
+                    VALUES %s
+                    ON CONFLICT (path) DO NOTHING
+                ''', folders, page_size=IMPORT_PAGE_SIZE)
+                execute_values(cur, '''
+                    INSERT INTO files (filename, folder_path, file_id, file_type, file_size, file_unique_id) 
+                    VALUES %s
+                    ON CONFLICT (filename, folder_path) 
+                    DO UPDATE SET 
+                        file_id = EXCLUDED.file_id, 
+                        file_type = EXCLUDED.file_type,
+                        file_size = EXCLUDED.file_size,
+                        file_unique_id = EXCLUDED.file_unique_id,
+                        created_at = CURRENT_TIMESTAMP
+                ''', files, page_size=IMPORT_PAGE_SIZE)
+                
+                self.rebuild_folder_stats(cur)
+                self.notify_reload(cur)
+            
+            self.cache.invalidate_subtree('/')
+            self.file_cache.invalidate_subtree('/')
+            logger.info(f"✅ Imported {len(folders)} folders and {len(files)} files" + (" (replaced library)" if replace else ""))
+            return True
+        except Exception as e:
+            logger.error(f"❌ Error importing tree: {e}")
+            return False
+
+    def get_folder_files(self, path, recursive=False, limit=DOWNLOAD_ALL_MAX):
+        """Get every file of a folder (and optionally its subfolders) in one query"""
         try:
-            with self.conn.cursor() as cur:
+            with self._cursor() as cur:
+                if recursive:
+                    cur.execute('''
+                        SELECT filename, file_id, file_type FROM files 
+                        WHERE folder_path = %s OR folder_path LIKE %s 
+                        ORDER BY folder_path, filename 
+                        LIMIT %s
+                    ''', (path, descendants_pattern(path), limit))
+                else:
+                    cur.execute('''
+                        SELECT filename, file_id, file_type FROM files 
+                        WHERE folder_path = %s 
+                        ORDER BY filename 
+                        LIMIT %s
+                    ''', (path, limit))
+                return cur.fetchall()
+        except Exception as e:
+            logger.error(f"❌ Error getting folder files: {e}")
+            return []
+
+    def get_folder(self, folder_id):
+        """Get a folder by primary key"""
+        try:
+            with self._cursor() as cur:
                 cur.execute('''
-                    SELECT file_id FROM files 
-                    WHERE filename = %s AND folder_path = %s
-                ''', (filename, folder_path))
+                    SELECT id, path, name, parent_path FROM folders 
+                    WHERE id = %s
+                ''', (folder_id,))
+                result = cur.fetchone()
+                if not result:
+                    return None
+                return dict(zip(('id', 'path', 'name', 'parent_path'), result))
+        except Exception as e:
+            logger.error(f"❌ Error getting folder: {e}")
+            return None
+
+    def get_file(self, file_pk):
+        """Get a file record by primary key, served from the file cache when possible"""
+        cached = self.file_cache.get(file_pk)
+        if cached is not None:
+            return cached
+        
+        generation = self.file_cache.generation
+        try:
+            with self._cursor() as cur:
+                cur.execute('''
+                    SELECT id, filename, folder_path, file_id, file_type FROM files 
+                    WHERE id = %s
+                ''', (file_pk,))
                 result = cur.fetchone()
-                return result[0] if result else None
+                if not result:
+                    return None
+                record = dict(zip(('id', 'filename', 'folder_path', 'file_id', 'file_type'), result))
+                self.file_cache.put(file_pk, record, generation)
+                return record
         except Exception as e:
-            logger.error(f"❌ Error getting file ID: {e}")
+            logger.error(f"❌ Error getting file: {e}")
             return None
 
+    def get_file_id(self, file_pk):
+        """Get Telegram file ID for download"""
+        record = self.get_file(file_pk)
+        return record['file_id'] if record else None
+
+    def get_content_stats(self):
+        """Distinct stored contents and their total size, each duplicate counted once"""
+        try:
+            with self._cursor() as cur:
+                cur.execute('SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM file_contents')
+                return cur.fetchone()
+        except Exception as e:
+            logger.error(f"❌ Error getting content stats: {e}")
+            return 0, 0
+
     def get_stats(self):
-        """Get database statistics"""
+        """Get library-wide folder count, file count and total size"""
         try:
-            with self.conn.cursor() as cur:
-                cur.execute('SELECT COUNT(*) FROM folders WHERE path != %s', ('/',))
-                folder_count = cur.fetchone()[0]
-                
-                cur.execute('SELECT COUNT(*) FROM files')
-                file_count = cur.fetchone()[0]
-                
-                cur.execute('SELECT COALESCE(SUM(file_size), 0)::BIGINT FROM files')
-                total_size_result = cur.fetchone()[0]
-                total_size = int(total_size_result) if total_size_result else 0
+            with self._cursor() as cur:
+                # Constant time: the root row of the trigger-maintained totals
+                cur.execute('''
+                    SELECT folder_count, file_count, total_size FROM folder_stats 
+                    WHERE path = '/'
+                ''')
+                result = cur.fetchone()
+                folder_count, file_count, total_size = result if result else (0, 0, 0)
                 
                 return folder_count, file_count, total_size
         except Exception as e:
             logger.error(f"❌ Error getting stats: {e}")
             return 0, 0, 0
 
-    def close(self):
-        """Close database connection"""
-        if self.conn:
-            self.conn.close()
-            logger.info("🔐 Database connection closed")
-
-# Initialize database
-try:
-    db = DatabaseManager()
-except Exception as e:
-    logger.error(f"❌ Failed to initialize database: {e}")
-    db = None
-
-# ===== STORAGE =====
-user_paths = {}  # track user navigation {user_id: ["Folder1", ...]}
-upload_context = {}  # track where admin is uploading {user_id: path_list}
+    def search(self, text, page=0, page_size=SEARCH_PAGE_SIZE, files_only=False):
+        """Find files and folders by name, best matches first.
 
-# ===== HELPERS =====
-def path_to_string(path_list):
-    """Convert path list to string"""
-    if not path_list:
-        return '/'
-    return '/' + '/'.join(path_list)
+        Returns (hits, has_next). Each hit is a dict with kind ('file' or
+        'folder'), id, name, path (the folder a file is in, or the folder
+        itself) and, for files, file_id and file_type.
+        """
+        params = {
+            'q': text,
+            'like': f"%{escape_like(text)}%",
+            'limit': page_size + 1,
+            'offset': page * page_size,
+        }
+        if self.has_trgm:
+            # Served by the trigram GIN indexes: fuzzy (%) and substring (ILIKE) matches
+            match = "{col} ILIKE %(like)s OR {col} %% %(q)s"
+            score = "similarity({col}, %(q)s)"
+        else:
+            match = "{col} ILIKE %(like)s"
+            score = "CASE WHEN lower({col}) = lower(%(q)s) THEN 1.0 ELSE 1.0 / (1 + length({col})) END"
+        
+        query = f'''
+            SELECT 'file' AS kind, id, filename AS name, folder_path AS path, file_id, file_type,
+                   {score.format(col='filename')} AS score
+            FROM files
+            WHERE {match.format(col='filename')}
+        '''
+        if not files_only:
+            query += f'''
+            UNION ALL
+            SELECT 'folder', id, name, path, NULL, NULL, {score.format(col='name')}
+            FROM folders
+            WHERE path <> '/' AND ({match.format(col='name')})
+            '''
+        query += '''
+            ORDER BY score DESC, name
+            LIMIT %(limit)s OFFSET %(offset)s
+        '''
+        try:
+            with self._cursor() as cur:
+                cur.execute(query, params)
+                rows = cur.fetchall()
+                columns = ('kind', 'id', 'name', 'path', 'file_id', 'file_type')
+                hits = [dict(zip(columns, row)) for row in rows[:page_size]]
+                return hits, len(rows) > page_size
+        except Exception as e:
+            logger.error(f"❌ Error searching: {e}")
+            return [], False
 
-def format_file_size(size_bytes):
-    """Format file size in human readable format"""
-    # Convert decimal.Decimal to float if needed
-    if size_bytes is None:
-        size_bytes = 0
-    size_bytes = float(size_bytes)
-    
-    if size_bytes == 0:
-        return "0 B"
-    size_names = ["B", "KB", "MB", "GB", "TB"]
-    i = 0
-    while size_bytes >= 1024 and i < len(size_names) - 1:
-        size_bytes /= 1024.0
-        i += 1
-    return f"{size_bytes:.1f} {size_names[i]}"
+    def get_folder_stats(self, path):
+        """Get recursive folder count, file count and total size of a folder"""
+        try:
+            with self._cursor() as cur:
+                cur.execute('''
+                    SELECT folder_count, file_count, total_size FROM folder_stats 
+                    WHERE path = %s
+                ''', (path,))
+                result = cur.fetchone()
+                return result if result else (0, 0, 0)
+        except Exception as e:
+            logger.error(f"❌ Error getting folder stats: {e}")
+            return 0, 0, 0
+
+    def get_course_stats(self, limit=10):
+        """Get recursive totals of the top-level (course) folders, largest first"""
+        try:
+            with self._cursor() as cur:
+                cur.execute('''
+                    SELECT f.name, COALESCE(s.file_count, 0), COALESCE(s.total_size, 0) 
+                    FROM folders f 
+                    LEFT JOIN folder_stats s ON s.path = f.path 
+                    WHERE f.parent_path = '/' 
+                    ORDER BY 3 DESC, f.name 
+                    LIMIT %s
+                ''', (limit,))
+                return cur.fetchall()
+        except Exception as e:
+            logger.error(f"❌ Error getting course stats: {e}")
+            return []
+
+    def log_activity(self, rows):
+        """Append (kind, user_id, folder_path, file_pk, created_at) rows with multi-row inserts"""
+        try:
+            with self._cursor() as cur:
+                execute_values(cur, '''
+                    INSERT INTO activity (kind, user_id, folder_path, file_pk, created_at) 
+                    VALUES %s
+                ''', rows, page_size=IMPORT_PAGE_SIZE)
+                return True
+        except Exception as e:
+            logger.error(f"❌ Error logging activity: {e}")
+            return False
+
+    def prune_activity(self, days=ACTIVITY_RETENTION_DAYS):
+        """Delete activity older than `days`; returns the number of rows removed"""
+        try:
+            with self._cursor() as cur:
+                cur.execute('''
+                    DELETE FROM activity 
+                    WHERE created_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+                ''', (days,))
+                return cur.rowcount
+        except Exception as e:
+            logger.error(f"❌ Error pruning activity: {e}")
+            return 0
+
+    def get_activity_stats(self, days=ACTIVITY_WINDOW_DAYS, limit=5):
+        """Most downloaded files, busiest folders and peak hours of the last `days`.
+
+        Returns a dict with 'events', 'top_files' [(filename, folder_path, n)],
+        'top_folders' [(path, n)] and 'peak_hours' [(hour, n)], hours in
+        LECTURE_TIMEZONE. Files and folders deleted since are left out.
+        """
+        params = {'days': days, 'limit': limit, 'tz': LECTURE_TIMEZONE}
+        recent = "a.created_at >= CURRENT_TIMESTAMP - make_interval(days => %(days)s)"
+        try:
+            with self._cursor() as cur:
+                cur.execute(f'SELECT COUNT(*) FROM activity a WHERE {recent}', params)
+                events = cur.fetchone()[0]
+                cur.execute(f'''
+                    SELECT f.filename, f.folder_path, COUNT(*) FROM activity a 
+                    JOIN files f ON f.id = a.file_pk 
+                    WHERE a.kind = 'download' AND {recent} 
+                    GROUP BY f.id, f.filename, f.folder_path 
+                    ORDER BY 3 DESC, 1 
+                    LIMIT %(limit)s
+                ''', params)
+                top_files = cur.fetchall()
+                cur.execute(f'''
+                    SELECT a.folder_path, COUNT(*) FROM activity a 
+                    JOIN folders d ON d.path = a.folder_path 
+                    WHERE {recent} 
+                    GROUP BY a.folder_path 
+                    ORDER BY 2 DESC, 1 
+                    LIMIT %(limit)s
+                ''', params)
+                top_folders = cur.fetchall()
+                cur.execute(f'''
+                    SELECT EXTRACT(HOUR FROM a.created_at AT TIME ZONE %(tz)s)::INTEGER, COUNT(*) FROM activity a 
+                    WHERE {recent} 
+                    GROUP BY 1 
+                    ORDER BY 2 DESC, 1 
+                    LIMIT %(limit)s
+                ''', params)
+                peak_hours = cur.fetchall()
+                return {'events': events, 'top_files': top_files, 'top_folders': top_folders, 'peak_hours': peak_hours}
+        except Exception as e:
+            logger.error(f"❌ Error getting activity stats: {e}")
+            return {'events': 0, 'top_files': [], 'top_folders': [], 'peak_hours': []}
+
+    def get_hot_folders(self, limit=PREWARM_FOLDERS, hour=None, days=ACTIVITY_WINDOW_DAYS):
+        """Paths of the busiest existing folders, optionally only counting one hour of the day"""
+        params = {'days': days, 'limit': limit, 'tz': LECTURE_TIMEZONE, 'hour': hour}
+        try:
+            with self._cursor() as cur:
+                cur.execute('''
+                    SELECT a.folder_path FROM activity a 
+                    JOIN folders d ON d.path = a.folder_path 
+                    WHERE a.created_at >= CURRENT_TIMESTAMP - make_interval(days => %(days)s) 
+                      AND (%(hour)s::INTEGER IS NULL 
+                           OR EXTRACT(HOUR FROM a.created_at AT TIME ZONE %(tz)s) = %(hour)s::INTEGER) 
+                    GROUP BY a.folder_path 
+                    ORDER BY COUNT(*) DESC, 1 
+                    LIMIT %(limit)s
+                ''', params)
+                return [row[0] for row in cur.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ Error getting hot folders: {e}")
+            return []
+
+    def prewarm(self, paths):
+        """Load the first listing page and the file records of these folders into the caches.
+
+        Returns the number of file records cached; the earliest paths win
+        when they hold more files than the file cache has room for.
+        """
+        for path in paths:
+            self.get_folder_page(path)
+        
+        generation = self.file_cache.generation
+        try:
+            with self._cursor() as cur:
+                cur.execute('''
+                    SELECT id, filename, folder_path, file_id, file_type FROM files 
+                    WHERE folder_path = ANY(%s) 
+                    ORDER BY array_position(%s, folder_path), filename 
+                    LIMIT %s
+                ''', (list(paths), list(paths), self.file_cache.maxsize))
+                rows = cur.fetchall()
+        except Exception as e:
+            logger.error(f"❌ Error prewarming file cache: {e}")
+            return 0
+        for row in reversed(rows):
+            self.file_cache.put(row[0], dict(zip(('id', 'filename', 'folder_path', 'file_id', 'file_type'), row)), generation)
+        return len(rows)
+
+    def load_session(self, user_id):
+        """Get a user's saved (path, upload_path)"""
+        try:
+            with self._cursor() as cur:
+                cur.execute('''
+                    SELECT path, upload_path FROM user_sessions 
+                    WHERE user_id = %s
+                ''', (user_id,))
+                return cur.fetchone()
+        except Exception as e:
+            logger.error(f"❌ Error loading session: {e}")
+            return None
+
+    def save_sessions(self, rows):
+        """Upsert many (user_id, path, upload_path) rows in one statement"""
+        try:
+            with self._cursor() as cur:
+                execute_values(cur, '''
+                    INSERT INTO user_sessions (user_id, path, upload_path) 
+                    VALUES %s
+                    ON CONFLICT (user_id) 
+                    DO UPDATE SET 
+                        path = EXCLUDED.path, 
+                        upload_path = EXCLUDED.upload_path,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', rows)
+                return True
+        except Exception as e:
+            logger.error(f"❌ Error saving sessions: {e}")
+            return False
+
+    def close(self):
+        """Close all pooled database connections"""
+        if self.pool:
+            self.pool.closeall()
+            logger.info("🔐 Database connections closed")
+
+def served_from_memory(method):
+    """Mark a method that never touches the database, so AsyncDatabaseManager calls it inline"""
+    method.in_memory = True
+    return method
+
+class SnapshotDatabaseManager(DatabaseManager):
+    """DatabaseManager that answers navigation reads from an in-memory tree.
+
+    The folders and files tables are loaded once at startup. A listener
+    thread with its own connection then applies the row notifications sent
+    by the notify triggers, so every replica sees every replica's writes;
+    a RELOAD notification (subtree moves and deletes) or a lost connection
+    triggers a full reload. Search and statistics still go to Postgres.
+
+    Listings are replaced, never modified in place, so readers on other
+    threads always see a consistent dict.
+    """
+
+    EMPTY_LISTING = {'subfolders': {}, 'files': {}}
+
+    def __init__(self):
+        self._lock = threading.Lock()  # serializes writers; readers never lock
+        self._folders = {}  # id -> (path, name, parent_path)
+        self._files = {}  # id -> (filename, folder_path, file_id, file_type, file_size)
+        self._listings = {}  # path -> {'subfolders': {name: id}, 'files': {filename: id}}
+        self._sync_waiters = {}  # token -> threading.Event
+        self._stop = threading.Event()
+        self._listen_conn = None
+        super().__init__()
+        self.enable_notify_triggers()
+        
+        # LISTEN before loading so nothing committed in between is missed
+        self._listen_conn = self._open_listener()
+        self.reload()
+        self._listener = threading.Thread(target=self._listen, name="snapshot-listener", daemon=True)
+        self._listener.start()
+
+    def enable_notify_triggers(self):
+        """Turn on the row triggers that feed SNAPSHOT_CHANNEL.
+
+        The switch is per table, so it covers writes from every replica
+        sharing the database, snapshot or not. It stays on after the last
+        snapshot replica is gone; run ALTER TABLE ... DISABLE TRIGGER
+        trg_<table>_notify by hand when leaving SNAPSHOT_MODE for good.
+        """
+        with self._transaction() as cur:
+            cur.execute('''
+                SELECT c.relname FROM pg_trigger t JOIN pg_class c ON c.oid = t.tgrelid
+                WHERE c.relname = ANY(%s) AND t.tgname = 'trg_' || c.relname || '_notify'
+                  AND t.tgenabled = 'D'
+            ''', (list(self.NOTIFY_TABLES),))
+            for (table,) in cur.fetchall():
+                cur.execute(f'ALTER TABLE {table} ENABLE TRIGGER trg_{table}_notify')
+                logger.info(f"🔔 Enabled change notifications on {table}")
+
+    def _open_listener(self):
+        conn = psycopg2.connect(DATABASE_URL, connect_timeout=DB_CONNECT_TIMEOUT, **self.connect_kwargs)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN {SNAPSHOT_CHANNEL}')
+        return conn
+
+    def reload(self):
+        """Replace the snapshot with a consistent copy of both tables"""
+        with self._transaction() as cur:
+            cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+            cur.execute('SELECT id, path, name, parent_path FROM folders')
+            folder_rows = cur.fetchall()
+            cur.execute('SELECT id, filename, folder_path, file_id, file_type, file_size FROM files')
+            file_rows = cur.fetchall()
+        
+        folders = {row[0]: row[1:] for row in folder_rows}
+        files = {row[0]: row[1:] for row in file_rows}
+        listings = {path: {'subfolders': {}, 'files': {}} for path, _, _ in folders.values()}
+        for folder_id, (path, name, parent_path) in folders.items():
+            if parent_path is not None:
+                listings.setdefault(parent_path, {'subfolders': {}, 'files': {}})['subfolders'][name] = folder_id
+        for file_pk, (filename, folder_path, *_) in files.items():
+            listings.setdefault(folder_path, {'subfolders': {}, 'files': {}})['files'][filename] = file_pk
+        
+        with self._lock:
+            self._folders, self._files, self._listings = folders, files, listings
+        metrics.inc("bot_snapshot_reloads_total")
+        logger.info(f"✅ Snapshot loaded: {len(folders)} folders, {len(files)} files")
+
+    def _listen(self):
+        delay = DB_RETRY_BACKOFF
+        while not self._stop.is_set():
+            try:
+                if self._listen_conn is None:
+                    self._listen_conn = self._open_listener()
+                    # Changes may have been missed while disconnected
+                    self.reload()
+                    delay = DB_RETRY_BACKOFF
+                
+                conn = self._listen_conn
+                if select.select([conn], [], [], 1) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self._apply(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.warning(f"⚠️ Snapshot listener lost its connection, retrying in {delay:.1f}s: {e}")
+                if self._listen_conn is not None:
+                    with suppress(Exception):
+                        self._listen_conn.close()
+                    self._listen_conn = None
+                self._stop.wait(delay)
+                delay = min(delay * 2, DB_RETRY_BACKOFF_MAX)
+
+    def _apply(self, payload):
+        """Apply one notification from SNAPSHOT_CHANNEL"""
+        event = json.loads(payload)
+        op = event['op']
+        metrics.inc("bot_snapshot_events_total", op=op.lower())
+        if op == 'SYNC':
+            waiter = self._sync_waiters.get(event['token'])
+            if waiter:
+                waiter.set()
+            return
+        if op == 'RELOAD':
+            self.reload()
+            return
+        
+        row = event['row']
+        with self._lock:
+            if event['table'] == 'folders':
+                self._drop_folder(row['id'], forget_listing=op == 'DELETE')
+                if op != 'DELETE':
+                    self._put_folder(row['id'], row['path'], row['name'], row['parent_path'])
+            else:
+                self._drop_file(row['id'])
+                if op != 'DELETE':
+                    self._put_file(row['id'], (row['filename'], row['folder_path'], row['file_id'],
+                                               row['file_type'], row['file_size']))
+
+    def _relist(self, path, kind, name, row_id=None):
+        """Copy-on-write change of one listing entry; row_id None removes it"""
+        listing = dict(self._listings.get(path, self.EMPTY_LISTING))
+        entries = dict(listing[kind])
+        if row_id is None:
+            entries.pop(name, None)
+        else:
+            entries[name] = row_id
+        listing[kind] = entries
+        self._listings[path] = listing
+
+    def _put_folder(self, folder_id, path, name, parent_path):
+        self._folders[folder_id] = (path, name, parent_path)
+        self._listings.setdefault(path, self.EMPTY_LISTING)
+        if parent_path is not None:
+            self._relist(parent_path, 'subfolders', name, folder_id)
+
+    def _drop_folder(self, folder_id, forget_listing=False):
+        folder = self._folders.pop(folder_id, None)
+        if folder:
+            path, name, parent_path = folder
+            if parent_path is not None:
+                self._relist(parent_path, 'subfolders', name)
+            if forget_listing:
+                self._listings.pop(path, None)
+
+    def _put_file(self, file_pk, record):
+        self._files[file_pk] = record
+        self._relist(record[1], 'files', record[0], file_pk)
+
+    def _drop_file(self, file_pk):
+        record = self._files.pop(file_pk, None)
+        if record:
+            self._relist(record[1], 'files', record[0])
+
+    def sync(self, timeout=2):
+        """Wait until the listener has applied everything this process committed so far.
+
+        Notifications arrive in commit order, so once our own marker comes
+        back, every earlier change is in the snapshot.
+        """
+        token = uuid.uuid4().hex
+        waiter = self._sync_waiters[token] = threading.Event()
+        try:
+            with self._cursor() as cur:
+                cur.execute('SELECT pg_notify(%s, %s)', (SNAPSHOT_CHANNEL, json.dumps({'op': 'SYNC', 'token': token})))
+            if not waiter.wait(timeout):
+                logger.warning("⚠️ Snapshot did not catch up in time, reads may be briefly stale")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not sync snapshot: {e}")
+        finally:
+            self._sync_waiters.pop(token, None)
+
+    def _synced(self, result):
+        if result:
+            self.sync()
+        return result
+
+    # Writes go to Postgres and return once the snapshot reflects them
+    def create_folder(self, parent_path, folder_name):
+        return self._synced(super().create_folder(parent_path, folder_name))
+
+    def delete_folder(self, parent_path, folder_name):
+        return self._synced(super().delete_folder(parent_path, folder_name))
+
+    def move_folder(self, folder_id, new_parent_path):
+        return self._synced(super().move_folder(folder_id, new_parent_path))
+
+    def add_files(self, folder_path, files):
+        return self._synced(super().add_files(folder_path, files))
+
+    def delete_file(self, folder_path, filename):
+        return self._synced(super().delete_file(folder_path, filename))
+
+    def import_tree(self, folders, files, replace=False):
+        return self._synced(super().import_tree(folders, files, replace))
+
+    @served_from_memory
+    def get_folder_structure(self, path='/'):
+        return self._listings.get(path, self.EMPTY_LISTING)
+
+    @served_from_memory
+    def get_folder_page(self, path='/', page=0, page_size=FOLDER_PAGE_SIZE, kind=None):
+        listing = self._listings.get(path, self.EMPTY_LISTING)
+        subfolders = sorted(listing['subfolders'].items()) if kind != 'files' else []
+        files = sorted(listing['files'].items()) if kind != 'subfolders' else []
+        start = page * page_size
+        end = start + page_size
+        return {
+            'subfolders': dict(subfolders[start:end]),
+            'files': dict(files[max(0, start - len(subfolders)):max(0, end - len(subfolders))]),
+            'page': page,
+            'has_next': len(subfolders) + len(files) > end,
+            'has_files': bool(files)
+        }
+
+    @served_from_memory
+    def get_folder(self, folder_id):
+        folder = self._folders.get(folder_id)
+        if not folder:
+            return None
+        return dict(zip(('id', 'path', 'name', 'parent_path'), (folder_id, *folder)))
+
+    @served_from_memory
+    def get_file(self, file_pk):
+        record = self._files.get(file_pk)
+        if not record:
+            return None
+        return dict(zip(('id', 'filename', 'folder_path', 'file_id', 'file_type'), (file_pk, *record[:4])))
+
+    @served_from_memory
+    def get_file_id(self, file_pk):
+        record = self._files.get(file_pk)
+        return record[2] if record else None
+
+    @served_from_memory
+    def prewarm(self, paths):
+        """Nothing to do: listings and file records are always in memory"""
+        return 0
+
+    @served_from_memory
+    def get_folder_files(self, path, recursive=False, limit=DOWNLOAD_ALL_MAX):
+        listings = self._listings
+        paths = sorted(p for p in list(listings) if is_same_or_descendant(p, path)) if recursive else [path]
+        result = []
+        for folder_path in paths:
+            for filename, file_pk in sorted(listings.get(folder_path, self.EMPTY_LISTING)['files'].items()):
+                record = self._files.get(file_pk)
+                if record:
+                    result.append((filename, record[2], record[3]))
+                    if len(result) >= limit:
+                        return result
+        return result
+
+    def close(self):
+        """Stop the listener and close every connection"""
+        self._stop.set()
+        self._listener.join(timeout=5)
+        if self._listen_conn is not None:
+            with suppress(Exception):
+                self._listen_conn.close()
+        super().close()
+
+class AsyncDatabaseManager:
+    """Async facade over DatabaseManager.
+
+    Exposes the same methods as DatabaseManager, but every call is awaited and
+    runs in a dedicated thread pool so a slow query never blocks the event loop.
+    """
+
+    def __init__(self, manager, max_workers=DB_WORKERS):
+        self.manager = manager
+        # More workers than pooled connections would only queue on the pool
+        max_workers = min(max_workers, DB_POOL_MAX)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+
+    def __getattr__(self, name):
+        attr = getattr(self.manager, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        if getattr(attr, 'in_memory', False):
+            # Answered from the snapshot: no query, so no thread hop either
+            async def direct(*args, **kwargs):
+                return attr(*args, **kwargs)
+            direct.__name__ = name
+            return direct
+
+        def timed(*args, **kwargs):
+            with metrics.timer("bot_db_query_seconds", method=name):
+                return attr(*args, **kwargs)
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(timed, *args, **kwargs))
+
+        call.__name__ = name
+        return call
+
+    def close(self):
+        """Close database connection and stop worker threads"""
+        self.manager.close()
+        self.executor.shutdown(wait=False)
+
+# Connected by init_database() from main(), so importing this module needs no database
+db = None
+
+def init_database():
+    """Connect, migrate and install the global `db`; returns it, or None on failure"""
+    global db
+    try:
+        db = AsyncDatabaseManager(SnapshotDatabaseManager() if SNAPSHOT_MODE else DatabaseManager())
+        mark_startup("database_ready")
+    except Exception as e:
+        logger.error(f"❌ Failed to initialize database: {e}")
+        db = None
+    return db
+
+# ===== STORAGE =====
+class UserSession:
+    """Where a user is: current folder and pending upload folder, as path strings"""
+    __slots__ = ('path', 'upload_path', 'last_seen', 'loaded_at', 'version')
+
+    def __init__(self, path='/', upload_path=None):
+        self.path = path
+        self.upload_path = upload_path
+        self.last_seen = self.loaded_at = time.monotonic()
+        self.version = 0  # bumped on every local change
+
+class PostgresSessionBackend:
+    """Sessions in the user_sessions table, shared by every bot replica"""
+    shared = True  # other processes write here too, so SessionStore re-reads it
+
+    async def load(self, user_id):
+        return await db.load_session(user_id) if db else None
+
+    async def save_many(self, rows):
+        return await db.save_sessions(rows) if db else False
+
+class FileSessionBackend:
+    """Sessions in a local JSON file, for development"""
+    shared = False
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._data = None
+
+    def _read(self):
+        try:
+            with open(self.filename, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"❌ Error reading session file: {e}")
+            return {}
+
+    def _write(self, data):
+        tmp = f"{self.filename}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.filename)
+
+    async def load(self, user_id):
+        if self._data is None:
+            self._data = await asyncio.to_thread(self._read)
+        saved = self._data.get(str(user_id))
+        return tuple(saved) if saved else None
+
+    async def save_many(self, rows):
+        if self._data is None:
+            self._data = await asyncio.to_thread(self._read)
+        for user_id, path, upload_path in rows:
+            self._data[str(user_id)] = [path, upload_path]
+        try:
+            await asyncio.to_thread(self._write, dict(self._data))
+            return True
+        except Exception as e:
+            logger.error(f"❌ Error writing session file: {e}")
+            return False
+
+class MemorySessionBackend:
+    """No persistence: positions reset on restart"""
+    shared = False
+
+    async def load(self, user_id):
+        return None
+
+    async def save_many(self, rows):
+        return True
+
+class SessionStore:
+    """Bounded in-memory navigation state with write-behind persistence.
+
+    Reads are served from memory; a user is loaded from the backend on their
+    first tap after a restart or eviction. Changes are marked dirty and
+    flushed in batches every SESSION_FLUSH_INTERVAL seconds, after which users
+    idle for SESSION_IDLE_TTL (or beyond SESSION_MAX_USERS) are evicted.
+
+    Replicas sharing a backend do not see each other's changes by default;
+    route a user's updates to one process. Setting SESSION_REFRESH_INTERVAL
+    re-reads a clean session older than that before use, at the cost of a
+    backend read every interval per active user. Sessions with a change
+    pending or being saved are never re-read, so a refresh cannot bring back
+    a position this replica has moved past.
+    """
+
+    def __init__(self, backend, idle_ttl=SESSION_IDLE_TTL, max_users=SESSION_MAX_USERS,
+                 refresh_interval=SESSION_REFRESH_INTERVAL):
+        self.backend = backend
+        self.idle_ttl = idle_ttl
+        self.max_users = max_users
+        self.refresh_interval = refresh_interval if getattr(backend, 'shared', False) else 0
+        self._sessions = OrderedDict()  # user_id -> UserSession, least recently used first
+        self._dirty = set()
+        self._flushing = set()  # saved by a flush that hasn't returned yet
+        self._task = None
+
+    async def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session is None:
+            saved = await self.backend.load(user_id)
+            # Another update from this user may have loaded it meanwhile
+            session = self._sessions.get(user_id)
+            if session is None:
+                session = UserSession(*saved) if saved else UserSession()
+                self._sessions[user_id] = session
+        elif (self.refresh_interval and user_id not in self._dirty
+              and user_id not in self._flushing
+              and time.monotonic() - session.loaded_at > self.refresh_interval):
+            version = session.version
+            saved = await self.backend.load(user_id)
+            # Unless it changed here while the backend was read
+            if saved and session.version == version:
+                session.path, session.upload_path = saved
+            session.loaded_at = time.monotonic()
+        session.last_seen = time.monotonic()
+        self._sessions.move_to_end(user_id)
+        return session
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def save(self, user_id):
+        """Mark a user's session as changed so the next flush persists it"""
+        if user_id in self._sessions:
+            self._sessions[user_id].version += 1
+            self._dirty.add(user_id)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = [
+            (user_id, self._sessions[user_id].path, self._sessions[user_id].upload_path)
+            for user_id in dirty if user_id in self._sessions
+        ]
+        if not rows:
+            return
+        self._flushing = dirty
+        try:
+            saved = await self.backend.save_many(rows)
+        finally:
+            self._flushing = set()
+        if not saved:
+            # Keep them dirty and try again on the next flush
+            self._dirty |= dirty
+
+    def evict(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        for user_id in list(self._sessions):
+            session = self._sessions[user_id]
+            if session.last_seen >= cutoff and len(self._sessions) <= self.max_users:
+                break  # everything after this is more recently used
+            if user_id not in self._dirty:
+                del self._sessions[user_id]
+
+    async def run(self, interval=SESSION_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+                self.evict()
+            except Exception as e:
+                logger.error(f"❌ Error flushing sessions: {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+def create_session_backend():
+    if SESSION_BACKEND == "file":
+        return FileSessionBackend(SESSION_FILE)
+    if SESSION_BACKEND == "memory":
+        return MemorySessionBackend()
+    return PostgresSessionBackend()
+
+sessions = SessionStore(create_session_backend())
+
+# ===== ACTIVITY LOG =====
+class ActivityLog:
+    """Write-behind log of downloads and folder opens.
+
+    record() only appends to an in-memory buffer, so a tap never waits on
+    the database. The buffer is written with multi-row inserts every
+    ACTIVITY_FLUSH_INTERVAL seconds, or as soon as ACTIVITY_FLUSH_SIZE events
+    are waiting. Events that fail to insert are kept for the next flush;
+    beyond ACTIVITY_BUFFER_MAX the oldest are dropped.
+    """
+
+    def __init__(self, flush_size=ACTIVITY_FLUSH_SIZE, max_buffered=ACTIVITY_BUFFER_MAX):
+        self.flush_size = flush_size
+        self.recorded = 0
+        self.flushed = 0
+        self.dropped = 0
+        self._buffer = deque(maxlen=max_buffered)  # (kind, user_id, folder_path, file_pk, created_at)
+        self._flushing = False
+        self._flush_task = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def record(self, kind, user_id, folder_path, file_pk=None):
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append((kind, user_id, folder_path, file_pk, datetime.now(timezone.utc)))
+        self.recorded += 1
+        if self._task and len(self._buffer) >= self.flush_size and not self._flushing:
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        if self._flushing or not self._buffer:
+            return
+        self._flushing = True
+        rows = list(self._buffer)
+        self._buffer.clear()
+        try:
+            saved = await db.log_activity(rows)
+        except Exception as e:
+            logger.error(f"❌ Error flushing activity: {e}")
+            saved = False
+        finally:
+            self._flushing = False
+        if saved:
+            self.flushed += len(rows)
+            return
+        # Put them back ahead of anything recorded meanwhile, dropping the oldest if full
+        retry = deque(rows, maxlen=self._buffer.maxlen)
+        retry.extend(self._buffer)
+        self.dropped += len(rows) + len(self._buffer) - len(retry)
+        self._buffer = retry
+
+    async def run(self, interval=ACTIVITY_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._flush_task:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
+
+activity_log = ActivityLog()
+
+def next_lecture_prewarm(now, hours=LECTURE_HOURS, lead=PREWARM_LEAD):
+    """(seconds to wait, lecture hour) for the next prewarm, `lead` seconds before one of `hours`"""
+    upcoming = []
+    for hour in hours:
+        at = now.replace(hour=hour, minute=0, second=0, microsecond=0) - timedelta(seconds=lead)
+        if at <= now:
+            at += timedelta(days=1)
+        upcoming.append(((at - now).total_seconds(), hour))
+    return min(upcoming)
+
+async def prewarm_caches(hour=None):
+    """Load the hottest folders into the listing and file caches.
+
+    With `hour`, folders are ranked by their activity during that hour of
+    the day, falling back to overall popularity when there is none yet.
+    """
+    paths = await db.get_hot_folders(hour=hour)
+    if not paths and hour is not None:
+        paths = await db.get_hot_folders()
+    if not paths:
+        return
+    with metrics.timer("bot_prewarm_seconds"):
+        file_count = await db.prewarm(paths)
+    when = f" for the {hour:02d}:00 lecture" if hour is not None else ""
+    logger.info(f"🔥 Prewarmed {len(paths)} folders and {file_count} files{when}")
+
+async def run_prewarm():
+    """Prewarm once at startup, then shortly before every LECTURE_HOURS hour"""
+    try:
+        await db.prune_activity()
+        await prewarm_caches()
+    except Exception as e:
+        logger.error(f"❌ Error prewarming caches: {e}")
+    if not LECTURE_HOURS:
+        return
+    lecture_zone = ZoneInfo(LECTURE_TIMEZONE)
+    while True:
+        delay, hour = next_lecture_prewarm(datetime.now(lecture_zone))
+        await asyncio.sleep(delay)
+        try:
+            await db.prune_activity()
+            await prewarm_caches(hour)
+        except Exception as e:
+            logger.error(f"❌ Error prewarming caches: {e}")
+
+# ===== HELPERS =====
+def path_to_string(path_list):
+    """Convert path list to string"""
+    if not path_list:
+        return '/'
+    return '/' + '/'.join(path_list)
+
+def string_to_path(path_string):
+    """Convert path string to path list"""
+    if not path_string or path_string == '/':
+        return []
+    return path_string.strip('/').split('/')
+
+def format_file_size(size_bytes):
+    """Format file size in human readable format"""
+    # Convert decimal.Decimal to float if needed
+    if size_bytes is None:
+        size_bytes = 0
+    size_bytes = float(size_bytes)
+    
+    if size_bytes == 0:
+        return "0 B"
+    size_names = ["B", "KB", "MB", "GB", "TB"]
+    i = 0
+    while size_bytes >= 1024 and i < len(size_names) - 1:
+        size_bytes /= 1024.0
+        i += 1
+    return f"{size_bytes:.1f} {size_names[i]}"
 
 async def safe_edit_message(query, text, reply_markup=None):
     """Safely edit message with error handling for 'Message is not modified' error"""
@@ -322,31 +2404,131 @@ def build_folder_buttons(folder_data: dict, is_admin=False):
     buttons = []
     
     # Add subfolder buttons
-    for name in sorted(folder_data.get("subfolders", {})):
+    subfolders = folder_data.get("subfolders", {})
+    for name in sorted(subfolders):
         if name and len(name.strip()) > 0:
-            buttons.append([InlineKeyboardButton(f"📁 {name[:50]}", callback_data=f"open_folder|{name}")])
+            buttons.append([InlineKeyboardButton(f"📁 {name[:50]}", callback_data=f"open_folder|{subfolders[name]}")])
     
     # Add file buttons
-    for filename in sorted(folder_data.get("files", {})):
+    files = folder_data.get("files", {})
+    for filename in sorted(files):
         if filename and len(filename.strip()) > 0:
             display_name = filename[:50] + "..." if len(filename) > 50 else filename
-            buttons.append([InlineKeyboardButton(f"📄 {display_name}", callback_data=f"download|{filename}")])
+            buttons.append([InlineKeyboardButton(f"📄 {display_name}", callback_data=f"download|{files[filename]}")])
+    
+    # Add page navigation for folders that don't fit on one keyboard
+    page = folder_data.get("page", 0)
+    nav_row = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton("◀️ Prev", callback_data=f"page|{page - 1}"))
+    if page > 0 or folder_data.get("has_next"):
+        nav_row.append(InlineKeyboardButton(f"📄 {page + 1}", callback_data=f"page|{page}"))
+    if folder_data.get("has_next"):
+        nav_row.append(InlineKeyboardButton("Next ▶️", callback_data=f"page|{page + 1}"))
+    if nav_row:
+        buttons.append(nav_row)
+    
+    # Whole-folder downloads; subfolders can fill page 0 and push every file to later pages
+    if page == 0 and folder_data.get("has_files", bool(files)):
+        buttons.append([InlineKeyboardButton("⬇️ Download All", callback_data="download_folder|0")])
+    if page == 0 and subfolders:
+        buttons.append([InlineKeyboardButton("⬇️ Download All + Subfolders", callback_data="download_folder|1")])
     
     if is_admin:
         buttons.append([InlineKeyboardButton("⚙️ Admin Panel", callback_data="admin_current")])
     
     return buttons
 
+def build_search_buttons(hits: list, page: int, has_next: bool):
+    """Build search result buttons: files download, folders open"""
+    buttons = []
+    for hit in hits:
+        if hit['kind'] == 'folder':
+            label = f"📁 {hit['path']}"
+            callback = f"open_folder|{hit['id']}"
+        else:
+            location = hit['path'].strip('/') or 'Root'
+            label = f"📄 {hit['name']} — {location}"
+            callback = f"download|{hit['id']}"
+        display_name = label[:60] + "..." if len(label) > 60 else label
+        buttons.append([InlineKeyboardButton(display_name, callback_data=callback)])
+    
+    nav_row = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton("◀️ Prev", callback_data=f"search_page|{page - 1}"))
+    if has_next:
+        nav_row.append(InlineKeyboardButton("Next ▶️", callback_data=f"search_page|{page + 1}"))
+    if nav_row:
+        buttons.append(nav_row)
+    
+    return buttons
+
+# ===== BULK DOWNLOADS =====
+# Telegram only groups documents with documents and audio with audio;
+# photos and videos can share an album
+MEDIA_GROUP_KINDS = {'document': 'document', 'audio': 'audio', 'photo': 'visual', 'video': 'visual'}
+INPUT_MEDIA_TYPES = {
+    'document': InputMediaDocument,
+    'audio': InputMediaAudio,
+    'photo': InputMediaPhoto,
+    'video': InputMediaVideo,
+}
+
+def plan_media_groups(files):
+    """Split (filename, file_id, file_type) rows into sendable groups of up to 10"""
+    by_kind = {}
+    for filename, file_id, file_type in files:
+        file_type = file_type if file_type in INPUT_MEDIA_TYPES else 'document'
+        by_kind.setdefault(MEDIA_GROUP_KINDS[file_type], []).append((filename, file_id, file_type))
+    
+    groups = []
+    for kind_files in by_kind.values():
+        for i in range(0, len(kind_files), 10):
+            groups.append(kind_files[i:i + 10])
+    return groups
+
+async def send_folder(bot, chat_id, files):
+    """Send files as media groups; the bot's rate limiter paces them"""
+    sent = 0
+    for group in plan_media_groups(files):
+        if len(group) == 1:
+            filename, file_id, file_type = group[0]
+            send = {
+                'photo': bot.send_photo,
+                'video': bot.send_video,
+                'audio': bot.send_audio,
+            }.get(file_type, bot.send_document)
+            await send(chat_id, file_id, caption=f"📄 {filename}")
+        else:
+            media = [INPUT_MEDIA_TYPES[file_type](file_id, caption=f"📄 {filename}") for filename, file_id, file_type in group]
+            await bot.send_media_group(chat_id, media)
+        sent += len(group)
+    return sent
+
+async def download_folder_task(bot, chat_id, user_data, folder_path, files):
+    try:
+        sent = await send_folder(bot, chat_id, files)
+        logger.info(f"✅ Folder downloaded: {folder_path} ({sent} files)")
+    except Exception as e:
+        logger.error(f"❌ Error sending folder {folder_path}: {e}")
+        await bot.send_message(chat_id, "❌ Error downloading folder, some files may be missing.")
+    finally:
+        user_data.pop("downloading_folder", None)
+
 # ===== COMMANDS =====
+@instrumented("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    user_paths[user.id] = []
     is_admin = user.username == ADMIN_USERNAME
     
     if not db:
         await update.message.reply_text("❌ Database connection failed. Please contact admin.")
         return
     
+    session = await sessions.get(user.id)
+    session.path = '/'
+    sessions.save(user.id)
+    
     platform = "🚂 Railway" if "railway" in os.environ.get("RAILWAY_ENVIRONMENT_NAME", "").lower() else "☁️ Cloud"
     
     await update.message.reply_text(
@@ -360,213 +2542,525 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
-# ===== BUTTON HANDLER =====
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
+@instrumented("search")
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not db:
-        await query.answer("❌ Database unavailable", show_alert=True)
+        await update.message.reply_text("❌ Database connection failed. Please contact admin.")
         return
     
-    # ---- CLOSE INTERFACE ----
-    if query.data == "close_interface":
-        try:
-            await query.message.delete()
-        except Exception as e:
-            logger.warning(f"Could not delete message: {e}")
+    text = " ".join(context.args).strip()
+    if len(text) < 2:
+        await update.message.reply_text("🔎 Usage: /search <part of a file or folder name>")
         return
     
-    user = query.from_user
-    is_admin = user.username == ADMIN_USERNAME
-    path = user_paths.get(user.id, [])
-    current_path = path_to_string(path)
-
-    # ---- BACK ----
-    if query.data == "back":
-        if path:
-            path.pop()
-            user_paths[user.id] = path
-            current_path = path_to_string(path)
-            
-        if path:
-            folder_data = db.get_folder_structure(current_path)
-            buttons = build_folder_buttons(folder_data, is_admin=is_admin)
-            path_display = " > ".join(path) if path else "Root"
-            await safe_edit_message(query, f"📂 Current Folder: {path_display}", add_back_button(buttons))
-        else:
-            await safe_edit_message(query, "📁 Main Menu", main_menu_buttons(is_admin))
+    context.user_data["search_query"] = text
+    hits, has_next = await db.search(text)
+    if not hits:
+        await update.message.reply_text(f"🔎 No results for '{text}'.")
         return
+    
+    buttons = build_search_buttons(hits, 0, has_next)
+    await update.message.reply_text(f"🔎 Results for '{text}':", reply_markup=add_back_button(buttons))
 
-    # ---- CLEAR INTERFACE ----
-    if query.data == "clear_interface":
-        chat_id = query.message.chat_id
-        # Delete recent messages
-        for message_id in range(query.message.message_id, max(1, query.message.message_id - 10), -1):
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-            except:
-                pass
-        
-        await context.bot.send_message(
-            chat_id, 
-            "🧹 Interface cleared.", 
-            reply_markup=main_menu_buttons(is_admin)
-        )
+INLINE_RESULT_TYPES = {
+    'photo': lambda hit, description: InlineQueryResultCachedPhoto(
+        str(hit['id']), hit['file_id'], title=hit['name'], description=description, caption=f"📄 {hit['name']}"),
+    'video': lambda hit, description: InlineQueryResultCachedVideo(
+        str(hit['id']), hit['file_id'], hit['name'], description=description, caption=f"📄 {hit['name']}"),
+    'audio': lambda hit, description: InlineQueryResultCachedAudio(
+        str(hit['id']), hit['file_id'], caption=f"📄 {hit['name']}"),
+}
+
+@instrumented("inline_search")
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answer @bot <name> queries with files that can be sent straight into any chat"""
+    inline_query = update.inline_query
+    text = inline_query.query.strip()
+    if not db or len(text) < 2:
+        await inline_query.answer([], cache_time=5)
         return
+    
+    page = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    hits, has_next = await db.search(text, page=page, files_only=True)
+    
+    results = []
+    for hit in hits:
+        description = hit['path'].strip('/') or 'Root'
+        build = INLINE_RESULT_TYPES.get(hit['file_type'])
+        if build:
+            results.append(build(hit, description))
+        else:
+            results.append(InlineQueryResultCachedDocument(
+                str(hit['id']), hit['name'], hit['file_id'], description=description, caption=f"📄 {hit['name']}"
+            ))
+    
+    await inline_query.answer(results, cache_time=30, next_offset=str(page + 1) if has_next else "")
 
-    # ---- BROWSE ROOT ----
-    if query.data == "browse_folders":
-        user_paths[user.id] = []
-        folder_data = db.get_folder_structure('/')
-        buttons = build_folder_buttons(folder_data, is_admin=is_admin)
-        await safe_edit_message(query, "📂 Root Folders:", add_back_button(buttons))
+@instrumented("export")
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the admin the whole library as a JSON tree document"""
+    if update.effective_user.username != ADMIN_USERNAME:
+        await update.message.reply_text("⛔ Admin access required")
+        return
+    if not db:
+        await update.message.reply_text("❌ Database unavailable.")
+        return
+    
+    tree = await db.export_tree()
+    if tree is None:
+        await update.message.reply_text("❌ Error exporting the library.")
         return
+    
+    folders, files = flatten_tree(tree)
+    await update.message.reply_document(
+        json.dumps(tree, ensure_ascii=False, indent=1).encode(),
+        filename="lectures-tree.json",
+        caption=f"📦 {len(folders)} folders, {len(files)} files"
+    )
 
-    # ---- OPEN FOLDER ----
-    if query.data.startswith("open_folder|"):
-        folder_name = query.data.split("|", 1)[1]
-        
-        path.append(folder_name)
-        user_paths[user.id] = path
-        new_path = path_to_string(path)
-        
-        folder_data = db.get_folder_structure(new_path)
-        buttons = build_folder_buttons(folder_data, is_admin=is_admin)
-        await safe_edit_message(query, f"📂 {folder_name}:", add_back_button(buttons))
+@instrumented("import")
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Wait for a tree document to import; '/import replace' empties the library first"""
+    if update.effective_user.username != ADMIN_USERNAME:
+        await update.message.reply_text("⛔ Admin access required")
         return
+    
+    replace = context.args[:1] == ["replace"]
+    context.user_data["awaiting_import"] = replace
+    await update.message.reply_text(
+        "📥 Send the exported JSON file now."
+        + (" ⚠️ The current library will be deleted first." if replace else " Existing folders and files are kept.")
+    )
 
-    # ---- DOWNLOAD FILE ----
-    if query.data.startswith("download|"):
-        filename = query.data.split("|", 1)[1]
-        file_id = db.get_file_id(current_path, filename)
-        
-        if file_id:
+# ===== CALLBACK ROUTING =====
+def parse_flag(raw):
+    """Payload of on/off buttons such as download_folder|1"""
+    return raw == "1"
+
+def parse_page(raw):
+    """Optional page number, as in delete_file_current|2; none means the first page"""
+    return max(0, int(raw)) if raw else 0
+
+class ButtonPress:
+    """A button press resolved by the router: who pressed it and its parsed payload"""
+    __slots__ = ('query', 'user', 'is_admin', 'payload', 'session')
+
+    def __init__(self, query, payload, session):
+        self.query = query
+        self.user = query.from_user
+        self.is_admin = self.user.username == ADMIN_USERNAME
+        self.payload = payload
+        self.session = session
+
+    @property
+    def current_path(self):
+        return self.session.path
+
+    @property
+    def path(self):
+        return string_to_path(self.session.path)
+
+class CallbackRouter:
+    """Dispatch table from callback action to route handler.
+
+    callback_data is "<action>" or "<action>|<payload>". The action is looked
+    up in a dict, so dispatch costs the same however many routes exist; the
+    payload is converted with the route's parser before the handler runs.
+    Admin routes are checked once here instead of inside every handler.
+    """
+
+    def __init__(self):
+        self.routes = {}  # action -> (handler, payload parser, admin only, needs session)
+
+    def route(self, action, payload=None, admin=False, session=True):
+        """Register the decorated coroutine as the handler for `action`"""
+        def decorate(func):
+            if action in self.routes:
+                raise ValueError(f"Duplicate callback route: {action}")
+            self.routes[action] = (func, payload, admin, session)
+            return func
+        return decorate
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        action, _, raw = (query.data or "").partition("|")
+        route = self.routes.get(action)
+        # Unknown actions share one label so stray callback data can't grow the metrics
+        with metrics.timer("bot_handler_seconds", handler="button", action=action if route else "unknown"):
+            await query.answer()
+            
+            if not db:
+                await query.answer("❌ Database unavailable", show_alert=True)
+                return
+            
+            if not route:
+                logger.warning(f"⚠️ Unknown callback data: {query.data!r}")
+                return
+            handler, parse, admin_only, needs_session = route
+            
             try:
-                await query.message.reply_document(file_id, caption=f"📄 {filename}")
-                logger.info(f"✅ File downloaded: {filename}")
-            except Exception as e:
-                logger.error(f"❌ Error sending file {filename}: {e}")
-                await query.answer("❌ Error downloading file", show_alert=True)
-        else:
-            await query.answer("❌ File not found", show_alert=True)
-        return
+                payload = parse(raw) if parse else None
+            except ValueError:
+                logger.warning(f"⚠️ Malformed callback data: {query.data!r}")
+                return
+            
+            press = ButtonPress(query, payload, await sessions.get(query.from_user.id) if needs_session else None)
+            if admin_only and not press.is_admin:
+                await query.answer("⛔ Admin access required", show_alert=True)
+                return
+            
+            await handler(press, context)
 
-    # Admin-only actions
-    if not is_admin:
-        await query.answer("⛔ Admin access required", show_alert=True)
-        return
+callbacks = CallbackRouter()
 
-    # ---- ADMIN MAIN PANEL ----
-    if query.data == "admin_main":
-        buttons = [
-            [InlineKeyboardButton("📂 Browse & Manage", callback_data="browse_folders")],
-            [InlineKeyboardButton("📊 Statistics", callback_data="admin_stats")],
-        ]
-        await safe_edit_message(query, "⚙️ Admin Main Panel", add_back_button(buttons))
-        return
+# ===== BUTTON HANDLERS =====
+@callbacks.route("close_interface", session=False)
+async def close_interface(press, context):
+    try:
+        await press.query.message.delete()
+    except Exception as e:
+        logger.warning(f"Could not delete message: {e}")
 
-    # ---- ADMIN STATS ----
-    if query.data == "admin_stats":
-        folder_count, file_count, total_size = db.get_stats()
-        from datetime import datetime
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        
-        platform = "🚂 Railway" if "railway" in os.environ.get("RAILWAY_ENVIRONMENT_NAME", "").lower() else "☁️ Cloud"
+@callbacks.route("back")
+async def go_back(press, context):
+    query = press.query
+    path = press.path
+    if path:
+        path.pop()
+        press.session.path = path_to_string(path)
+        sessions.save(press.user.id)
         
-        stats_text = (
-            f"📊 **Bot Statistics** (Updated: {timestamp}):\n\n"
-            f"📁 Total Folders: **{folder_count}**\n"
-            f"📄 Total Files: **{file_count}**\n"
-            f"💾 Total Size: **{format_file_size(total_size)}**\n"
-            f"🗄️ Database: **PostgreSQL (Persistent)**\n"
-            f"🌐 Platform: **{platform}**"
-        )
-        
-        buttons = [[InlineKeyboardButton("🔄 Refresh", callback_data="admin_stats")]]
-        await safe_edit_message(query, stats_text, add_back_button(buttons))
-        return
-
-    # ---- ADMIN CURRENT FOLDER PANEL ----
-    if query.data == "admin_current":
-        buttons = [
-            [InlineKeyboardButton("📁 Create Folder", callback_data="create_folder_current")],
-            [InlineKeyboardButton("📤 Upload File", callback_data="upload_current")],
-            [InlineKeyboardButton("❌ Delete Folder", callback_data="delete_folder_current")],
-            [InlineKeyboardButton("🗑️ Delete File", callback_data="delete_file_current")]
-        ]
+    if path:
+        folder_data = await db.get_folder_page(press.current_path)
+        buttons = build_folder_buttons(folder_data, is_admin=press.is_admin)
         path_display = " > ".join(path) if path else "Root"
-        await safe_edit_message(query, f"⚙️ Admin Panel\n📍 Current: {path_display}", add_back_button(buttons))
-        return
+        await safe_edit_message(query, f"📂 Current Folder: {path_display}", add_back_button(buttons))
+    else:
+        await safe_edit_message(query, "📁 Main Menu", main_menu_buttons(press.is_admin))
 
-    # ---- CREATE FOLDER ----
-    if query.data == "create_folder_current":
-        context.user_data["awaiting_folder_name"] = True
-        context.user_data["folder_path"] = path.copy()
-        await safe_edit_message(query, "✏️ Send the name for the new folder:")
-        return
+@callbacks.route("clear_interface", session=False)
+async def clear_interface(press, context):
+    query = press.query
+    chat_id = query.message.chat_id
+    # Delete the messages we know about, all at once
+    message_ids = set(message_tracker.pop_all(chat_id))
+    message_ids.add(query.message.message_id)
+    results = await asyncio.gather(
+        *(context.bot.delete_message(chat_id=chat_id, message_id=message_id) for message_id in message_ids),
+        return_exceptions=True
+    )
+    failed = sum(isinstance(result, Exception) for result in results)
+    if failed:
+        logger.warning(f"Could not delete {failed} of {len(results)} messages")
+    
+    await context.bot.send_message(
+        chat_id, 
+        "🧹 Interface cleared.", 
+        reply_markup=main_menu_buttons(press.is_admin)
+    )
 
-    # ---- UPLOAD FILE ----
-    if query.data == "upload_current":
-        upload_context[user.id] = path.copy()
-        await safe_edit_message(query, "📤 Now send the file to upload into this folder.")
+@callbacks.route("browse_folders")
+async def browse_folders(press, context):
+    press.session.path = '/'
+    sessions.save(press.user.id)
+    folder_data = await db.get_folder_page('/')
+    buttons = build_folder_buttons(folder_data, is_admin=press.is_admin)
+    await safe_edit_message(press.query, "📂 Root Folders:", add_back_button(buttons))
+
+@callbacks.route("open_folder", payload=int)
+async def open_folder(press, context):
+    query = press.query
+    folder = await db.get_folder(press.payload)
+    if not folder:
+        await query.answer("❌ Folder not found", show_alert=True)
         return
+    
+    press.session.path = folder['path']
+    sessions.save(press.user.id)
+    activity_log.record('open', press.user.id, folder['path'])
+    
+    folder_data = await db.get_folder_page(folder['path'])
+    buttons = build_folder_buttons(folder_data, is_admin=press.is_admin)
+    await safe_edit_message(query, f"📂 {folder['name']}:", add_back_button(buttons))
 
-    # ---- DELETE FOLDER MENU ----
-    if query.data == "delete_folder_current":
-        folder_data = db.get_folder_structure(current_path)
-        subfolders = folder_data.get("subfolders", {})
-        
-        if not subfolders:
-            await safe_edit_message(query, "⚠️ No subfolders to delete.", add_back_button([]))
-            return
-            
-        buttons = []
-        for name in sorted(subfolders.keys()):
-            display_name = name[:40] + "..." if len(name) > 40 else name
-            buttons.append([InlineKeyboardButton(f"🗑️ {display_name}", callback_data=f"delete_folder_select|{name}")])
-            
-        await safe_edit_message(query, "🗑️ Select a folder to delete:", add_back_button(buttons))
+@callbacks.route("page", payload=int)
+async def folder_page(press, context):
+    page = max(0, press.payload)
+    path = press.path
+    
+    folder_data = await db.get_folder_page(press.current_path, page)
+    buttons = build_folder_buttons(folder_data, is_admin=press.is_admin)
+    title = f"📂 {path[-1]}:" if path else "📂 Root Folders:"
+    await safe_edit_message(press.query, title, add_back_button(buttons))
+
+@callbacks.route("search_page", payload=int, session=False)
+async def search_page(press, context):
+    query = press.query
+    page = max(0, press.payload)
+    text = context.user_data.get("search_query")
+    if not text:
+        await query.answer("🔎 Search expired, use /search again", show_alert=True)
         return
+    
+    hits, has_next = await db.search(text, page=page)
+    buttons = build_search_buttons(hits, page, has_next)
+    await safe_edit_message(query, f"🔎 Results for '{text}' (page {page + 1}):", add_back_button(buttons))
 
-    # ---- DELETE SELECTED FOLDER ----
-    if query.data.startswith("delete_folder_select|"):
-        folder_name = query.data.split("|", 1)[1]
-        
-        if db.delete_folder(current_path, folder_name):
-            await safe_edit_message(query, f"✅ Folder '{folder_name}' deleted successfully.", add_back_button([]))
-        else:
-            await safe_edit_message(query, "❌ Error deleting folder.", add_back_button([]))
+@callbacks.route("download_folder", payload=parse_flag)
+async def download_folder(press, context):
+    query = press.query
+    current_path = press.current_path
+    if context.user_data.get("downloading_folder"):
+        await query.answer("⏳ A folder download is already in progress", show_alert=True)
         return
+    
+    files = await db.get_folder_files(current_path, recursive=press.payload)
+    if not files:
+        await query.answer("⚠️ No files to download", show_alert=True)
+        return
+    
+    note = f" (first {DOWNLOAD_ALL_MAX})" if len(files) >= DOWNLOAD_ALL_MAX else ""
+    await query.message.reply_text(f"⬇️ Sending {len(files)} files{note}...")
+    activity_log.record('download_folder', press.user.id, current_path)
+    # Send in the background so this user's other taps aren't held up
+    context.user_data["downloading_folder"] = True
+    context.application.create_task(
+        download_folder_task(context.bot, query.message.chat_id, context.user_data, current_path, files)
+    )
 
-    # ---- DELETE FILE MENU ----
-    if query.data == "delete_file_current":
-        folder_data = db.get_folder_structure(current_path)
-        files = folder_data.get("files", {})
-        
-        if not files:
-            await safe_edit_message(query, "⚠️ No files to delete.", add_back_button([]))
-            return
+@callbacks.route("download", payload=int, session=False)
+async def download_file(press, context):
+    query = press.query
+    file = await db.get_file(press.payload)
+    
+    if file:
+        filename = file['filename']
+        try:
+            await query.message.reply_document(file['file_id'], caption=f"📄 {filename}")
+            activity_log.record('download', press.user.id, file['folder_path'], file['id'])
+            logger.info(f"✅ File downloaded: {filename}")
+        except Exception as e:
+            logger.error(f"❌ Error sending file {filename}: {e}")
+            await query.answer("❌ Error downloading file", show_alert=True)
+    else:
+        await query.answer("❌ File not found", show_alert=True)
+
+# ---- ADMIN ROUTES ----
+@callbacks.route("admin_main", admin=True, session=False)
+async def admin_main(press, context):
+    buttons = [
+        [InlineKeyboardButton("📂 Browse & Manage", callback_data="browse_folders")],
+        [InlineKeyboardButton("📊 Statistics", callback_data="admin_stats")],
+        [InlineKeyboardButton("🔥 Activity", callback_data="admin_activity")],
+    ]
+    await safe_edit_message(press.query, "⚙️ Admin Main Panel", add_back_button(buttons))
+
+@callbacks.route("admin_stats", admin=True, session=False)
+async def admin_stats(press, context):
+    folder_count, file_count, total_size = await db.get_stats()
+    unique_files, unique_size = await db.get_content_stats()
+    course_stats = await db.get_course_stats()
+    cache_stats = db.cache.stats()
+    file_cache_stats = db.file_cache.stats()
+    send_stats = context.bot.rate_limiter.counters if context.bot.rate_limiter else None
+    timestamp = datetime.now().strftime("%H:%M:%S")
+    
+    platform = "🚂 Railway" if "railway" in os.environ.get("RAILWAY_ENVIRONMENT_NAME", "").lower() else "☁️ Cloud"
+    
+    stats_text = (
+        f"📊 **Bot Statistics** (Updated: {timestamp}):\n\n"
+        f"📁 Total Folders: **{folder_count}**\n"
+        f"📄 Total Files: **{file_count}**\n"
+        f"💾 Total Size: **{format_file_size(total_size)}** "
+        f"(**{format_file_size(unique_size)}** deduplicated, {file_count - unique_files} duplicate copies)\n"
+        f"🗄️ Database: **PostgreSQL (Persistent)**\n"
+        f"🧠 Listing Cache: **{cache_stats['hits']}** hits / **{cache_stats['misses']}** misses "
+        f"({cache_stats['hit_ratio']:.0%}, {cache_stats['size']} cached)\n"
+        f"🧠 File Cache: **{file_cache_stats['hits']}** hits / **{file_cache_stats['misses']}** misses "
+        f"({file_cache_stats['hit_ratio']:.0%}, {file_cache_stats['size']} cached)\n"
+    )
+    if send_stats:
+        stats_text += (
+            f"🚦 Telegram Calls: **{send_stats['requests']}** sent, **{send_stats['throttled']}** throttled, "
+            f"**{send_stats['retry_after']}** rate-limited\n"
+        )
+    throttled = update_throttle.counters
+    stats_text += (
+        f"🛡️ Incoming Updates: **{throttled['admitted']}** handled, **{throttled['coalesced']}** coalesced, "
+        f"**{throttled['dropped_user'] + throttled['dropped_global']}** dropped\n"
+    )
+    stats_text += f"🌐 Platform: **{platform}**"
+    if course_stats:
+        stats_text += "\n\n📚 **Size per course:**\n" + "\n".join(
+            f"• {name}: {count} files, {format_file_size(size)}"
+            for name, count, size in course_stats
+        )
+    
+    buttons = [[InlineKeyboardButton("🔄 Refresh", callback_data="admin_stats")]]
+    await safe_edit_message(press.query, stats_text, add_back_button(buttons))
+
+@callbacks.route("admin_activity", admin=True, session=False)
+async def admin_activity(press, context):
+    activity = await db.get_activity_stats()
+    
+    text = (
+        f"🔥 **Activity** (last {ACTIVITY_WINDOW_DAYS} days):\n\n"
+        f"👆 Events: **{activity['events']}** logged, **{len(activity_log)}** waiting to be written"
+        + (f", **{activity_log.dropped}** dropped" if activity_log.dropped else "") + "\n"
+    )
+    if activity['top_files']:
+        text += "\n⬇️ **Most downloaded:**\n" + "\n".join(
+            f"• {filename} ({folder_path}): {count}" for filename, folder_path, count in activity['top_files']
+        ) + "\n"
+    if activity['top_folders']:
+        text += "\n📂 **Busiest folders:**\n" + "\n".join(
+            f"• {path}: {count}" for path, count in activity['top_folders']
+        ) + "\n"
+    if activity['peak_hours']:
+        text += f"\n🕐 **Peak hours** ({LECTURE_TIMEZONE}):\n" + "\n".join(
+            f"• {hour:02d}:00–{hour:02d}:59: {count}" for hour, count in activity['peak_hours']
+        ) + "\n"
+    if LECTURE_HOURS:
+        text += "\n🔥 Caches prewarmed before " + ", ".join(f"{hour:02d}:00" for hour in LECTURE_HOURS)
+    
+    buttons = [[InlineKeyboardButton("🔄 Refresh", callback_data="admin_activity")]]
+    await safe_edit_message(press.query, text, add_back_button(buttons))
+
+@callbacks.route("admin_current", admin=True)
+async def admin_current(press, context):
+    buttons = [
+        [InlineKeyboardButton("📁 Create Folder", callback_data="create_folder_current")],
+        [InlineKeyboardButton("📤 Upload File", callback_data="upload_current")],
+        [InlineKeyboardButton("❌ Delete Folder", callback_data="delete_folder_current")],
+        [InlineKeyboardButton("🗑️ Delete File", callback_data="delete_file_current")],
+        [InlineKeyboardButton("✂️ Move Folder", callback_data="move_folder_current")]
+    ]
+    if context.user_data.get("move_folder_id"):
+        move_name = context.user_data.get("move_folder_name", "")
+        buttons.append([InlineKeyboardButton(f"📥 Move '{move_name[:30]}' Here", callback_data="move_folder_here")])
+    path = press.path
+    path_display = " > ".join(path) if path else "Root"
+    folder_count, file_count, total_size = await db.get_folder_stats(press.current_path)
+    await safe_edit_message(
+        press.query,
+        f"⚙️ Admin Panel\n📍 Current: {path_display}\n"
+        f"📦 Contains: {folder_count} folders, {file_count} files, {format_file_size(total_size)}",
+        add_back_button(buttons)
+    )
+
+@callbacks.route("create_folder_current", admin=True)
+async def create_folder_current(press, context):
+    context.user_data["awaiting_folder_name"] = True
+    context.user_data["folder_path"] = press.path
+    await safe_edit_message(press.query, "✏️ Send the name for the new folder:")
+
+@callbacks.route("upload_current", admin=True)
+async def upload_current(press, context):
+    press.session.upload_path = press.current_path
+    sessions.save(press.user.id)
+    await safe_edit_message(press.query, "📤 Now send the file to upload into this folder.")
+
+async def pick_from_listing(press, kind, icon, menu, action, title, empty_text):
+    """Show one button per subfolder or file of the current folder, a page at a time.
+
+    `menu` is the route that shows this picker; its payload is the page.
+    """
+    page = press.payload
+    folder_data = await db.get_folder_page(press.current_path, page, kind=kind)
+    entries = folder_data.get(kind, {})
+    
+    if not entries and page == 0:
+        await safe_edit_message(press.query, empty_text, add_back_button([]))
+        return
         
-        buttons = []
-        for filename in sorted(files.keys()):
-            display_name = filename[:40] + "..." if len(filename) > 40 else filename
-            buttons.append([InlineKeyboardButton(f"🗑️ {display_name}", callback_data=f"delete_file_select|{filename}")])
+    buttons = []
+    for name in sorted(entries.keys()):
+        display_name = name[:40] + "..." if len(name) > 40 else name
+        buttons.append([InlineKeyboardButton(f"{icon} {display_name}", callback_data=f"{action}|{entries[name]}")])
+    
+    nav_row = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton("◀️ Prev", callback_data=f"{menu}|{page - 1}"))
+    if folder_data.get("has_next"):
+        nav_row.append(InlineKeyboardButton("Next ▶️", callback_data=f"{menu}|{page + 1}"))
+    if nav_row:
+        buttons.append(nav_row)
         
-        await safe_edit_message(query, "🗑️ Select a file to delete:", add_back_button(buttons))
+    await safe_edit_message(press.query, title, add_back_button(buttons))
+
+@callbacks.route("move_folder_current", payload=parse_page, admin=True)
+async def move_folder_current(press, context):
+    await pick_from_listing(press, "subfolders", "✂️", "move_folder_current", "move_folder_select",
+                            "✂️ Select a folder to move:", "⚠️ No subfolders to move.")
+
+@callbacks.route("move_folder_select", payload=int, admin=True, session=False)
+async def move_folder_select(press, context):
+    folder = await db.get_folder(press.payload)
+    if not folder or folder['path'] == '/':
+        await safe_edit_message(press.query, "⚠️ Folder no longer exists.", add_back_button([]))
         return
+    
+    context.user_data["move_folder_id"] = folder['id']
+    context.user_data["move_folder_name"] = folder['name']
+    await safe_edit_message(
+        press.query,
+        f"✂️ '{folder['name']}' selected.\n"
+        f"Browse to the destination and choose 📥 Move Here from its Admin Panel.",
+        add_back_button([])
+    )
 
-    # ---- DELETE SELECTED FILE ----
-    if query.data.startswith("delete_file_select|"):
-        filename = query.data.split("|", 1)[1]
-        
-        if db.delete_file(current_path, filename):
-            await safe_edit_message(query, f"✅ File '{filename}' deleted successfully.", add_back_button([]))
-        else:
-            await safe_edit_message(query, "❌ Error deleting file.", add_back_button([]))
+@callbacks.route("move_folder_here", admin=True)
+async def move_folder_here(press, context):
+    folder_id = context.user_data.pop("move_folder_id", None)
+    folder_name = context.user_data.pop("move_folder_name", "")
+    
+    if folder_id and await db.move_folder(folder_id, press.current_path):
+        await safe_edit_message(press.query, f"✅ Folder '{folder_name}' moved successfully.", add_back_button([]))
+    else:
+        await safe_edit_message(
+            press.query,
+            "❌ Could not move folder. The destination may be inside it or already have a folder with that name.",
+            add_back_button([])
+        )
+
+@callbacks.route("delete_folder_current", payload=parse_page, admin=True)
+async def delete_folder_current(press, context):
+    await pick_from_listing(press, "subfolders", "🗑️", "delete_folder_current", "delete_folder_select",
+                            "🗑️ Select a folder to delete:", "⚠️ No subfolders to delete.")
+
+@callbacks.route("delete_folder_select", payload=int, admin=True, session=False)
+async def delete_folder_select(press, context):
+    folder = await db.get_folder(press.payload)
+    if not folder or folder['path'] == '/':
+        await safe_edit_message(press.query, "⚠️ Folder no longer exists.", add_back_button([]))
         return
+    
+    folder_name = folder['name']
+    if await db.delete_folder(folder['parent_path'], folder_name):
+        await safe_edit_message(press.query, f"✅ Folder '{folder_name}' deleted successfully.", add_back_button([]))
+    else:
+        await safe_edit_message(press.query, "❌ Error deleting folder.", add_back_button([]))
+
+@callbacks.route("delete_file_current", payload=parse_page, admin=True)
+async def delete_file_current(press, context):
+    await pick_from_listing(press, "files", "🗑️", "delete_file_current", "delete_file_select",
+                            "🗑️ Select a file to delete:", "⚠️ No files to delete.")
+
+@callbacks.route("delete_file_select", payload=int, admin=True, session=False)
+async def delete_file_select(press, context):
+    file = await db.get_file(press.payload)
+    if not file:
+        await safe_edit_message(press.query, "⚠️ File no longer exists.", add_back_button([]))
+        return
+    
+    filename = file['filename']
+    if await db.delete_file(file['folder_path'], filename):
+        await safe_edit_message(press.query, f"✅ File '{filename}' deleted successfully.", add_back_button([]))
+    else:
+        await safe_edit_message(press.query, "❌ Error deleting file.", add_back_button([]))
 
 # ===== HANDLE TEXT (FOLDER NAMES) =====
+@instrumented("handle_text")
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user.username != ADMIN_USERNAME:
@@ -593,7 +3087,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         path = context.user_data.get("folder_path", [])
         parent_path = path_to_string(path)
         
-        if db.create_folder(parent_path, name):
+        if await db.create_folder(parent_path, name):
             await update.message.reply_text(f"✅ Folder '{name}' created successfully.")
         else:
             await update.message.reply_text("⚠️ Folder already exists or error occurred.")
@@ -601,6 +3095,167 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["awaiting_folder_name"] = False
 
 # ===== HANDLE FILE UPLOADS =====
+def extract_file_info(message):
+    """Get (filename, file_id, file_type, file_size, file_unique_id) of an uploaded file, or None"""
+    if message.document:
+        file = message.document
+        filename = file.file_name or f"document_{file.file_unique_id}"
+        file_type = "document"
+        
+    elif message.photo:
+        # A photo arrives in several resolutions; keep the largest
+        file = message.photo[-1]
+        filename = f"photo_{file.file_unique_id}.jpg"
+        file_type = "photo"
+        
+    elif message.video:
+        file = message.video
+        filename = f"video_{file.file_unique_id}.mp4"
+        file_type = "video"
+        
+    elif message.audio:
+        file = message.audio
+        filename = file.file_name or f"audio_{file.file_unique_id}.mp3"
+        file_type = "audio"
+        
+    else:
+        return None
+
+    # Validate filename
+    if not filename or len(filename) > 200:
+        filename = f"file_{file.file_id[:10]}"
+    
+    return filename, file.file_id, file_type, file.file_size or 0, file.file_unique_id
+
+class UploadBatcher:
+    """Collects an admin's uploads and stores them in one bulk insert.
+
+    Albums arrive as one message per file, and forwarded piles of PDFs as a
+    burst of messages. Every upload joins the user's open batch, which is
+    written and summarised once nothing new arrived for `window` seconds (or
+    as soon as it holds `max_files`).
+    """
+
+    def __init__(self, window=UPLOAD_BATCH_WINDOW, max_files=UPLOAD_BATCH_MAX):
+        self.window = window
+        self.max_files = max_files
+        self._batches = {}  # user_id -> {'folder_path', 'files', 'message', 'timer'}
+
+    def add(self, application, user_id, folder_path, file_info, message):
+        """Buffer one upload; returns the folder the batch is going to"""
+        batch = self._batches.get(user_id)
+        if batch is None:
+            batch = self._batches[user_id] = {'folder_path': folder_path, 'files': [], 'message': None, 'timer': None}
+        batch['files'].append(file_info)
+        batch['message'] = message
+        if batch['timer']:
+            batch['timer'].cancel()
+        
+        if len(batch['files']) >= self.max_files:
+            batch['timer'] = None
+            application.create_task(self.flush(user_id))
+        else:
+            # A timer handle rather than a sleeping task: cancelling a task that
+            # has not started yet would leave its coroutine never awaited
+            batch['timer'] = asyncio.get_running_loop().call_later(
+                self.window, lambda: application.create_task(self.flush(user_id))
+            )
+        return batch['folder_path']
+
+    async def flush(self, user_id):
+        batch = self._batches.pop(user_id, None)
+        if not batch:
+            return
+        
+        folder_path = batch['folder_path']
+        message = batch['message']
+        # A re-sent file replaces the earlier one, like add_file's upsert;
+        # the same content sent twice in one batch is kept once
+        files, seen = [], set()
+        for info in {info[0]: info for info in batch['files']}.values():
+            if (info[4] or info[0]) not in seen:
+                seen.add(info[4] or info[0])
+                files.append(info)
+        path = string_to_path(folder_path)
+        path_display = " > ".join(path) if path else "Root"
+        
+        try:
+            # Contents already stored here are skipped; copies elsewhere are noted
+            copies = await db.find_copies([info[4] for info in files if info[4]])
+            new_files, notes = [], []
+            for info in files:
+                places = copies.get(info[4], [])
+                here = [name for place, name in places if place == folder_path]
+                if here:
+                    notes.append(f"♻️ {info[0]} is already here as {here[0]}, skipped")
+                    continue
+                new_files.append(info)
+                if places:
+                    elsewhere = ", ".join(place for place, _ in places[:3])
+                    notes.append(f"♻️ {info[0]} also exists at {elsewhere}")
+            note_text = "\n\n" + "\n".join(notes) if notes else ""
+            files = new_files
+            
+            if not files:
+                await message.reply_text(f"✅ Nothing new to upload to {path_display}.{note_text}")
+                return
+            
+            if not await db.add_files(folder_path, files):
+                await message.reply_text(f"❌ Error uploading {len(files)} file(s) to database.")
+                return
+            
+            if len(files) == 1:
+                filename, file_id, file_type, file_size, _ = files[0]
+                await message.reply_text(
+                    f"✅ File uploaded successfully!\n\n"
+                    f"📄 **{filename}**\n"
+                    f"📍 Location: {path_display}\n"
+                    f"📊 Size: {format_file_size(file_size)}\n"
+                    f"🏷️ Type: {file_type}"
+                    f"{note_text}",
+                    parse_mode='Markdown'
+                )
+                return
+            
+            listing = "\n".join(f"📄 {info[0]} ({format_file_size(info[3])})" for info in files[:30])
+            if len(files) > 30:
+                listing += f"\n… and {len(files) - 30} more"
+            total_size = sum(info[3] for info in files)
+            await message.reply_text(
+                f"✅ {len(files)} files uploaded successfully!\n\n"
+                f"📍 Location: {path_display}\n"
+                f"📊 Total size: {format_file_size(total_size)}\n\n"
+                f"{listing}"
+                f"{note_text}"
+            )
+        except Exception as e:
+            logger.error(f"❌ Error uploading files: {e}")
+            await message.reply_text(f"❌ Error uploading files: {str(e)}")
+
+    async def stop(self):
+        """Write every batch still waiting on its timer"""
+        for batch in self._batches.values():
+            if batch['timer']:
+                batch['timer'].cancel()
+        await asyncio.gather(*(self.flush(user_id) for user_id in list(self._batches)), return_exceptions=True)
+
+upload_batcher = UploadBatcher()
+
+async def import_document(update: Update, replace):
+    """Import the tree document the admin just sent"""
+    try:
+        telegram_file = await update.message.document.get_file()
+        folders, files = parse_tree(bytes(await telegram_file.download_as_bytearray()))
+    except ValueError as e:
+        await update.message.reply_text(f"❌ Not a valid tree document: {e}")
+        return
+    
+    if await db.import_tree(folders, files, replace=replace):
+        await update.message.reply_text(f"✅ Imported {len(folders)} folders and {len(files)} files.")
+    else:
+        await update.message.reply_text("❌ Import failed, nothing was changed.")
+
+@instrumented("handle_file")
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user.username != ADMIN_USERNAME:
@@ -611,72 +3266,23 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Database unavailable.")
         return
 
-    path = upload_context.get(user.id, user_paths.get(user.id, []))
-    folder_path = path_to_string(path)
+    if "awaiting_import" in context.user_data and update.message.document:
+        await import_document(update, context.user_data.pop("awaiting_import"))
+        return
 
-    try:
-        filename = None
-        file_id = None
-        file_type = "document"
-        file_size = 0
-        
-        if update.message.document:
-            file = update.message.document
-            filename = file.file_name or f"document_{file.file_unique_id}"
-            file_id = file.file_id
-            file_type = "document"
-            file_size = file.file_size or 0
-            
-        elif update.message.photo:
-            photo = update.message.photo[-1]
-            filename = f"photo_{photo.file_unique_id}.jpg"
-            file_id = photo.file_id
-            file_type = "photo"
-            file_size = photo.file_size or 0
-            
-        elif update.message.video:
-            video = update.message.video
-            filename = f"video_{video.file_unique_id}.mp4"
-            file_id = video.file_id
-            file_type = "video"
-            file_size = video.file_size or 0
-            
-        elif update.message.audio:
-            audio = update.message.audio
-            filename = audio.file_name or f"audio_{audio.file_unique_id}.mp3"
-            file_id = audio.file_id
-            file_type = "audio"
-            file_size = audio.file_size or 0
-            
-        else:
-            await update.message.reply_text("❌ Unsupported file type.")
-            return
+    file_info = extract_file_info(update.message)
+    if not file_info:
+        await update.message.reply_text("❌ Unsupported file type.")
+        return
 
-        # Validate filename
-        if not filename or len(filename) > 200:
-            filename = f"file_{file_id[:10]}"
-
-        # Add file to database
-        if db.add_file(folder_path, filename, file_id, file_type, file_size):
-            path_display = " > ".join(path) if path else "Root"
-            size_str = format_file_size(file_size)
-            await update.message.reply_text(
-                f"✅ File uploaded successfully!\n\n"
-                f"📄 **{filename}**\n"
-                f"📍 Location: {path_display}\n"
-                f"📊 Size: {size_str}\n"
-                f"🏷️ Type: {file_type}",
-                parse_mode='Markdown'
-            )
-        else:
-            await update.message.reply_text("❌ Error uploading file to database.")
-        
-        # Clear upload context
-        upload_context.pop(user.id, None)
-        
-    except Exception as e:
-        logger.error(f"❌ Error uploading file: {e}")
-        await update.message.reply_text(f"❌ Error uploading file: {str(e)}")
+    session = await sessions.get(user.id)
+    folder_path = session.upload_path or session.path
+    upload_batcher.add(context.application, user.id, folder_path, file_info, update.message)
+    
+    # Clear upload context; the rest of this batch follows the first file
+    if session.upload_path:
+        session.upload_path = None
+        sessions.save(user.id)
 
 # ===== ERROR HANDLER =====
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -692,7 +3298,452 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         except:
             pass
 
+# ===== UPDATE PROCESSING =====
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently while keeping each user's updates in order.
+
+    Updates from different users run in parallel, up to max_concurrent_updates.
+    Updates from the same user wait on a per-user lock, so navigation state
+    (sessions, user_data) is never mutated by two handlers
+    at once. Locks only exist while a user has updates in flight.
+    """
+
+    def __init__(self, max_concurrent_updates: int, throttle=None):
+        super().__init__(max_concurrent_updates)
+        self.throttle = throttle  # UpdateThrottle consulted before an update joins its user's queue
+        self._locks = {}  # user_id -> [asyncio.Lock, number of updates holding or waiting]
+
+    @staticmethod
+    def _ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def process_update(self, update, coroutine):
+        """Wait for the user's turn first and only then for a concurrency slot.
+
+        BaseUpdateProcessor takes the slot around do_process_update, which
+        would let one user's queued updates hold slots while they wait.
+        """
+        if self.throttle is not None and isinstance(update, Update):
+            reason = self.throttle.admit(update)
+            if reason:
+                coroutine.close()
+                await self.throttle.reject(update, reason)
+                return
+        key = self._ordering_key(update)
+        if key is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+        else:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0], self._semaphore:
+                    await self.do_process_update(update, coroutine)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+        mark_startup("first_update_answered")
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# ===== MESSAGE TRACKING =====
+class MessageTracker:
+    """Ring buffer of recent message ids per chat, both the bot's and the user's.
+
+    Lets "Clear Interface" delete exactly the messages that exist instead of
+    guessing at the last ten ids.
+    """
+
+    def __init__(self, per_chat=TRACKED_MESSAGES_PER_CHAT, max_chats=TRACKED_CHATS_MAX):
+        self.per_chat = per_chat
+        self.max_chats = max_chats
+        self._chats = OrderedDict()  # chat_id -> deque of message ids, least recently active first
+
+    def add(self, chat_id, message_id):
+        ids = self._chats.get(chat_id)
+        if ids is None:
+            ids = self._chats[chat_id] = deque(maxlen=self.per_chat)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+        ids.append(message_id)
+
+    def add_result(self, result):
+        """Record the message(s) returned by a send* Bot API call"""
+        for message in result if isinstance(result, list) else [result]:
+            if isinstance(message, dict) and 'message_id' in message and 'chat' in message:
+                self.add(message['chat']['id'], message['message_id'])
+
+    def pop_all(self, chat_id):
+        """Forget and return every tracked id of a chat"""
+        return list(self._chats.pop(chat_id, ()))
+
+message_tracker = MessageTracker()
+
+async def track_incoming(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Remember the user's own messages (commands, uploads, folder names)"""
+    if update.message and update.effective_chat:
+        message_tracker.add(update.effective_chat.id, update.message.message_id)
+
+# ===== RATE LIMITING =====
+class TokenBucket:
+    """Refills `rate` tokens per second up to `capacity`"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, cost=1):
+        """Take `cost` tokens if one is available and return 0, else return seconds to wait.
+
+        A cost above the balance leaves the bucket in debt, so a 10-file album
+        goes out at once but delays what comes after it.
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= cost
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self, cost=1):
+        """Give back tokens taken by a reservation that was not used"""
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+class ThrottleState:
+    """What UpdateThrottle remembers about one user"""
+    __slots__ = ('bucket', 'last_data', 'last_at', 'warned')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.last_data = None  # callback data of the last admitted button press
+        self.last_at = 0.0
+        self.warned = False  # told to slow down since the last admitted update
+
+class UpdateThrottle:
+    """Per-user and global token buckets for incoming updates.
+
+    Checked before an update waits on its user's lock, so a flood of button
+    presses is shed before it reaches a handler or the database. A button
+    press identical to the same user's previous one within
+    THROTTLE_COALESCE_WINDOW seconds is coalesced into it: the first press
+    already does the work. Each tracked user costs one ThrottleState; the
+    least recently seen are forgotten beyond THROTTLE_MAX_USERS. The admin
+    is never throttled.
+    """
+
+    def __init__(self, user_rate=THROTTLE_USER_RATE, user_burst=THROTTLE_USER_BURST,
+                 global_rate=THROTTLE_GLOBAL_RATE, window=THROTTLE_COALESCE_WINDOW,
+                 max_users=THROTTLE_MAX_USERS):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.overall = TokenBucket(global_rate, global_rate) if global_rate > 0 else None
+        self.window = window
+        self.max_users = max_users
+        self.counters = {'admitted': 0, 'coalesced': 0, 'dropped_user': 0, 'dropped_global': 0}
+        self._users = OrderedDict()  # user_id -> ThrottleState, least recently seen first
+
+    def __len__(self):
+        return len(self._users)
+
+    def _state(self, user_id):
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = ThrottleState(TokenBucket(self.user_rate, self.user_burst))
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return state
+
+    def admit(self, update):
+        """None if the update may be handled, else why not: 'coalesced', 'user' or 'global'"""
+        user = update.effective_user
+        if user is None or user.username == ADMIN_USERNAME:
+            return None
+        state = self._state(user.id)
+        data = update.callback_query.data if update.callback_query else None
+        now = time.monotonic()
+        if data is not None and data == state.last_data and now - state.last_at < self.window:
+            self.counters['coalesced'] += 1
+            return 'coalesced'
+        if state.bucket.reserve():
+            self.counters['dropped_user'] += 1
+            return 'user'
+        if self.overall and self.overall.reserve():
+            state.bucket.refund()
+            self.counters['dropped_global'] += 1
+            return 'global'
+        
+        self.counters['admitted'] += 1
+        state.warned = False
+        if data is not None:
+            state.last_data, state.last_at = data, now
+        return None
+
+    async def reject(self, update, reason):
+        """Answer a rejected button press so its spinner stops.
+
+        Only the first press dropped in a flood gets a "slow down" toast;
+        coalesced and later dropped presses are answered without text.
+        """
+        query = update.callback_query
+        if query is None:
+            return
+        text = None
+        if reason != 'coalesced':
+            state = self._users.get(update.effective_user.id)
+            if state is not None and not state.warned:
+                state.warned = True
+                text = "⏳ Too many taps, please slow down"
+        with suppress(TelegramError):
+            await query.answer(text)
+
+update_throttle = UpdateThrottle()
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """Global plus per-chat token buckets in front of every Bot API call.
+
+    Interactive calls (callback answers, edits, deletes, plain replies) go
+    ahead of bulk file sends whenever the global bucket is contended. A 429
+    RetryAfter pauses every outgoing call for the requested time and is then
+    retried, up to RATE_LIMIT_MAX_RETRIES times.
+    """
+
+    BULK_ENDPOINTS = frozenset({'sendDocument', 'sendPhoto', 'sendVideo', 'sendAudio', 'sendMediaGroup'})
+    MAX_CHAT_BUCKETS = 4096
+
+    def __init__(self, overall_rate=RATE_LIMIT_GLOBAL, chat_rate=RATE_LIMIT_CHAT,
+                 chat_burst=RATE_LIMIT_CHAT_BURST, group_rate=RATE_LIMIT_GROUP / 60,
+                 max_retries=RATE_LIMIT_MAX_RETRIES, tracker=None):
+        self.tracker = tracker  # MessageTracker that records every message the bot sends
+        self.overall = TokenBucket(overall_rate, overall_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.counters = {'requests': 0, 'throttled': 0, 'retry_after': 0, 'failed': 0}
+        self._chats = OrderedDict()  # chat_id -> TokenBucket, least recently used first
+        self._interactive_waiting = 0
+        self._resume = None  # set while no RetryAfter pause is in effect
+
+    async def initialize(self):
+        self._resume = asyncio.Event()
+        self._resume.set()
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Negative ids are groups and channels, which Telegram limits per minute
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_rate * 60)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                # Forget chats whose bucket has fully refilled
+                for key in [key for key, old in self._chats.items() if old.is_full()]:
+                    del self._chats[key]
+            self._chats[chat_id] = bucket
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _take(self, bucket, cost, interactive):
+        """Wait for a token; bulk calls yield to waiting interactive ones"""
+        throttled = False
+        if interactive:
+            self._interactive_waiting += 1
+        try:
+            while True:
+                if interactive or not self._interactive_waiting:
+                    delay = bucket.reserve(cost)
+                    if not delay:
+                        return throttled
+                else:
+                    delay = 0.05
+                throttled = True
+                await asyncio.sleep(delay)
+        finally:
+            if interactive:
+                self._interactive_waiting -= 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        interactive = endpoint not in self.BULK_ENDPOINTS
+        chat_id = data.get("chat_id")
+        with suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+        # Only sending messages counts against a chat's limit
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None and endpoint.startswith('send') else None
+        cost = len(data.get("media") or ()) or 1
+        self.counters['requests'] += 1
+
+        for attempt in range(max_retries + 1):
+            await self._resume.wait()
+            throttled = False
+            if chat_bucket:
+                throttled |= await self._take(chat_bucket, cost, interactive)
+            throttled |= await self._take(self.overall, 1, interactive)
+            if throttled:
+                self.counters['throttled'] += 1
+            
+            try:
+                result = await callback(*args, **kwargs)
+                if self.tracker and endpoint.startswith('send'):
+                    self.tracker.add_result(result)
+                return result
+            except RetryAfter as e:
+                self.counters['retry_after'] += 1
+                metrics.inc("bot_telegram_errors_total", error="RetryAfter")
+                if attempt == max_retries:
+                    self.counters['failed'] += 1
+                    logger.error(f"❌ Rate limited on {endpoint} after {max_retries} retries")
+                    raise
+                logger.warning(f"⚠️ Rate limited on {endpoint}, pausing sends for {e.retry_after}s")
+                self._resume.clear()
+                try:
+                    await asyncio.sleep(float(e.retry_after) + 0.1)
+                finally:
+                    self._resume.set()
+            except TelegramError as e:
+                metrics.inc("bot_telegram_errors_total", error=type(e).__name__)
+                raise
+
+# ===== LIFECYCLE =====
+def collect_runtime_metrics():
+    """Counters owned by other components, read at scrape time"""
+    samples = []
+    if db:
+        cache_stats = db.cache.stats()
+        samples += [
+            ("bot_cache_hits_total", "counter", "Folder listing cache hits", [({}, cache_stats['hits'])]),
+            ("bot_cache_misses_total", "counter", "Folder listing cache misses", [({}, cache_stats['misses'])]),
+            ("bot_db_reconnects_total", "counter", "Database connections dropped and replaced", [({}, db.manager.reconnects)]),
+        ]
+        file_cache_stats = db.file_cache.stats()
+        samples += [
+            ("bot_file_cache_hits_total", "counter", "File record cache hits", [({}, file_cache_stats['hits'])]),
+            ("bot_file_cache_misses_total", "counter", "File record cache misses", [({}, file_cache_stats['misses'])]),
+        ]
+    samples.append(("bot_sessions_in_memory", "gauge", "User sessions held in memory", [({}, len(sessions))]))
+    samples.append(("bot_updates_throttled_total", "counter", "Incoming updates not handled, by reason",
+                    [({'reason': reason}, value) for reason, value in update_throttle.counters.items() if reason != 'admitted']))
+    samples.append(("bot_throttle_users", "gauge", "Users tracked by the incoming update throttle", [({}, len(update_throttle))]))
+    samples += [
+        ("bot_activity_events_total", "counter", "Activity events recorded", [({}, activity_log.recorded)]),
+        ("bot_activity_flushed_total", "counter", "Activity events written to the database", [({}, activity_log.flushed)]),
+        ("bot_activity_dropped_total", "counter", "Activity events dropped from a full buffer", [({}, activity_log.dropped)]),
+        ("bot_activity_buffered", "gauge", "Activity events waiting to be written", [({}, len(activity_log))]),
+    ]
+    samples.append(("bot_startup_seconds", "gauge", "Seconds from process start to each startup stage",
+                    [({'stage': stage}, seconds) for stage, seconds in startup_timings.items()]))
+    return samples
+
+metrics.add_collector(collect_runtime_metrics)
+
+async def post_init(application: Application) -> None:
+    """Start background tasks once the application is initialized"""
+    mark_startup("bot_ready")
+    sessions.start()
+    activity_log.start()
+    application.bot_data["prewarm_task"] = asyncio.create_task(run_prewarm())
+    
+    if METRICS_PORT:
+        limiter = application.bot.rate_limiter
+        if limiter:
+            metrics.add_collector(lambda: [
+                (f"bot_telegram_{name}_total", "counter", f"Telegram API calls: {name}", [({}, value)])
+                for name, value in limiter.counters.items()
+            ])
+        application.bot_data["metrics_server"] = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+        logger.info(f"📈 Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def post_stop(application: Application) -> None:
+    """Finish buffered uploads while the bot can still confirm them"""
+    await upload_batcher.stop()
+
+async def post_shutdown(application: Application) -> None:
+    """Persist in-memory state before the process exits"""
+    await sessions.stop()
+    prewarm_task = application.bot_data.pop("prewarm_task", None)
+    if prewarm_task:
+        prewarm_task.cancel()
+    await activity_log.stop()
+    
+    server = application.bot_data.pop("metrics_server", None)
+    if server:
+        server.close()
+
 # ===== MAIN =====
+def build_application(token, request=None, rate_limited=True, throttled=None):
+    """Build the Application with every handler registered.
+
+    `request` replaces the HTTP transport to the Bot API, which lets the
+    benchmark harness run the real handlers against a fake Telegram;
+    `rate_limited=False` drops the outgoing token buckets and, unless
+    `throttled` says otherwise, the incoming update throttle for the same purpose.
+    """
+    throttle = update_throttle if (rate_limited if throttled is None else throttled) else None
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY, throttle=throttle))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if rate_limited:
+        builder = builder.rate_limiter(TokenBucketRateLimiter(tracker=message_tracker))
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
+    
+    # Add handlers
+    app.add_handler(TypeHandler(Update, track_incoming), group=-1)
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("search", search_command))
+    app.add_handler(CommandHandler("export", export_command))
+    app.add_handler(CommandHandler("import", import_command))
+    app.add_handler(InlineQueryHandler(inline_search))
+    app.add_handler(CallbackQueryHandler(callbacks.dispatch))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    app.add_handler(MessageHandler(
+        (filters.Document.ALL | filters.PHOTO | filters.VIDEO | filters.AUDIO) & ~filters.COMMAND, 
+        handle_file
+    ))
+    
+    # Add error handler
+    app.add_error_handler(error_handler)
+    return app
+
 def main():
     if not TOKEN:
         logger.error("❌ BOT_TOKEN environment variable is required")
@@ -706,31 +3757,40 @@ def main():
         logger.error("❌ DATABASE_URL or PostgreSQL environment variables are required")
         return
 
-    if not db:
+    if BOT_MODE not in ("polling", "webhook"):
+        logger.error(f"❌ BOT_MODE must be 'polling' or 'webhook', got '{BOT_MODE}'")
+        return
+
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        logger.error("❌ WEBHOOK_URL environment variable is required in webhook mode")
+        return
+
+    if not init_database():
         logger.error("❌ Database connection failed - cannot start bot")
         return
 
     try:
-        app = Application.builder().token(TOKEN).build()
-        
-        # Add handlers
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CallbackQueryHandler(button))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-        app.add_handler(MessageHandler(
-            (filters.Document.ALL | filters.PHOTO | filters.VIDEO | filters.AUDIO) & ~filters.COMMAND, 
-            handle_file
-        ))
-        
-        # Add error handler
-        app.add_error_handler(error_handler)
+        app = build_application(TOKEN)
         
         # Detect platform
         platform = "Railway" if os.environ.get("RAILWAY_ENVIRONMENT_NAME") else "Cloud Platform"
         logger.info(f"✅ File Manager Bot starting on {platform} with PostgreSQL persistence...")
         
-        # Start polling
-        app.run_polling(drop_pending_updates=True)
+        if BOT_MODE == "webhook":
+            # Telegram pushes updates to the built-in HTTP server
+            logger.info(f"🌐 Webhook mode: listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+            app.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                drop_pending_updates=DROP_PENDING_UPDATES
+            )
+        else:
+            # Start polling
+            app.run_polling(drop_pending_updates=DROP_PENDING_UPDATES)
         
     except Exception as e:
         logger.error(f"❌ Failed to start bot: {e}")
@@ -739,5 +3799,48 @@ def main():
         if db:
             db.close()
 
+def run_cli(argv):
+    """Maintenance commands that run without starting the bot"""
+    parser = argparse.ArgumentParser(
+        prog="bot.py",
+        description="Lecture library maintenance. Run without arguments to start the bot."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="write the whole library as a JSON tree document")
+    export.add_argument("file", nargs="?", default="-", help="output file, '-' for stdout")
+    load = commands.add_parser("import", help="load a tree document or a legacy folders.json")
+    load.add_argument("file")
+    load.add_argument("--replace", action="store_true", help="delete the current library first")
+    args = parser.parse_args(argv)
+    
+    if not init_database():
+        return 1
+    manager = db.manager
+    try:
+        if args.command == "export":
+            tree = manager.export_tree()
+            if tree is None:
+                return 1
+            text = json.dumps(tree, ensure_ascii=False, indent=1)
+            if args.file == "-":
+                print(text)
+            else:
+                with open(args.file, "w", encoding="utf-8") as f:
+                    f.write(text)
+                logger.info(f"✅ Exported library to {args.file}")
+            return 0
+        
+        try:
+            with open(args.file, "rb") as f:
+                folders, files = parse_tree(f.read())
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Could not read {args.file}: {e}")
+            return 1
+        return 0 if manager.import_tree(folders, files, replace=args.replace) else 1
+    finally:
+        db.close()
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
     main()
@@ -0,0 +1,499 @@
+"""Unit tests for the pure helpers in bot.py; none of them needs a database.
+
+Run with: python -m pytest -q
+"""
+import asyncio
+import threading
+from contextlib import nullcontext
+from datetime import datetime
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+import psycopg2
+import pytest
+
+import bot
+
+
+def fake_update(user_id, data=None, username="student"):
+    """Just enough of an Update for UpdateThrottle"""
+    query = SimpleNamespace(data=data) if data is not None else None
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id, username=username), callback_query=query)
+
+
+# ---- TokenBucket ----
+def test_token_bucket_allows_burst_then_asks_to_wait():
+    bucket = bot.TokenBucket(rate=1, capacity=3)
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+    assert bucket.reserve() > 0
+
+
+def test_token_bucket_refills_over_time(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    bucket = bot.TokenBucket(rate=2, capacity=2)
+    bucket.reserve()
+    bucket.reserve()
+    assert bucket.reserve() == pytest.approx(0.5)
+    now[0] += 0.5
+    assert bucket.reserve() == 0
+    now[0] += 10
+    assert bucket.is_full()
+
+
+def test_token_bucket_cost_above_balance_leaves_debt():
+    bucket = bot.TokenBucket(rate=1, capacity=1)
+    assert bucket.reserve(cost=10) == 0
+    assert bucket.reserve() == pytest.approx(10, abs=0.1)
+
+
+def test_rate_limiter_keeps_a_new_chat_bucket_when_evicting(monkeypatch):
+    monkeypatch.setattr(bot.TokenBucketRateLimiter, "MAX_CHAT_BUCKETS", 3)
+    limiter = bot.TokenBucketRateLimiter()
+    for chat_id in range(3):
+        limiter._chat_bucket(chat_id).reserve()  # still refilling, so kept
+    bucket = limiter._chat_bucket(3)  # full, like every new bucket
+    assert limiter._chats[3] is bucket and list(limiter._chats) == [0, 1, 2, 3]
+
+
+# ---- Connection pool ----
+class FakeConnection:
+    closed = False
+    autocommit = True
+
+    def cursor(self, cursor_factory=None):
+        return nullcontext(SimpleNamespace(connection=self))
+
+
+class FakePool:
+    def __init__(self, conns=(), error=None):
+        self.conns = list(conns)
+        self.error = error
+        self.returned = []
+
+    def getconn(self):
+        if self.error:
+            raise self.error
+        return self.conns.pop()
+
+    def putconn(self, conn, close=False):
+        self.returned.append((conn, close))
+
+
+def pooled_manager(pool):
+    manager = object.__new__(bot.DatabaseManager)
+    manager.pool = pool
+    manager.reconnects = 0
+    manager._slots = threading.BoundedSemaphore(2)
+    manager._last_used = {}
+    return manager
+
+
+def test_checkout_returns_the_slot_when_the_pool_fails():
+    manager = pooled_manager(FakePool(error=bot.PoolError("connection pool exhausted")))
+    for _ in range(3):
+        with pytest.raises(bot.PoolError):
+            manager._checkout()
+    assert manager._slots._value == 2
+
+
+def test_statement_timeout_keeps_the_connection_and_the_pool_warm():
+    conn, other = FakeConnection(), FakeConnection()
+    pool = FakePool([conn])
+    manager = pooled_manager(pool)
+    manager._last_used = {id(conn): bot.time.monotonic(), id(other): bot.time.monotonic()}
+    with pytest.raises(psycopg2.errors.QueryCanceled):
+        with manager._cursor():
+            raise psycopg2.errors.QueryCanceled("canceling statement due to statement timeout")
+    assert pool.returned == [(conn, False)]
+    assert id(other) in manager._last_used and manager._slots._value == 2
+
+
+# ---- Caches ----
+def test_folder_cache_invalidates_listings_by_folder():
+    cache = bot.FolderCache()
+    for key in (('/A', 0), ('/A', 1), ('/A/B', 0), ('/C', None)):
+        cache.put(key, 'listing')
+    cache.invalidate('/A')
+    assert cache.get(('/A', 0)) is None and cache.get(('/A/B', 0)) == 'listing'
+    cache.invalidate_subtree('/A')
+    assert cache.get(('/A/B', 0)) is None and cache.get(('/C', None)) == 'listing'
+
+
+def test_file_cache_drops_only_records_of_the_written_folders():
+    cache = bot.FolderCache(path_of=lambda key, record: record['folder_path'])
+    for file_pk, folder_path in ((1, '/A'), (2, '/A/B'), (3, '/C')):
+        cache.put(file_pk, {'id': file_pk, 'folder_path': folder_path})
+    cache.invalidate('/A')
+    assert [cache.get(file_pk) is not None for file_pk in (1, 2, 3)] == [False, True, True]
+    cache.invalidate_subtree('/A')
+    assert [cache.get(file_pk) is not None for file_pk in (2, 3)] == [False, True]
+
+
+# ---- UpdateThrottle ----
+def test_throttle_coalesces_identical_callbacks_within_window():
+    throttle = bot.UpdateThrottle(user_rate=100, user_burst=100, global_rate=0, window=60)
+    assert throttle.admit(fake_update(1, "open_folder|5")) is None
+    assert throttle.admit(fake_update(1, "open_folder|5")) == 'coalesced'
+    assert throttle.admit(fake_update(1, "open_folder|6")) is None
+    assert throttle.admit(fake_update(2, "open_folder|6")) is None
+    assert throttle.counters['coalesced'] == 1
+
+
+def test_throttle_drops_beyond_user_burst():
+    throttle = bot.UpdateThrottle(user_rate=0.001, user_burst=3, global_rate=0, window=0)
+    verdicts = [throttle.admit(fake_update(1, f"page|{i}")) for i in range(5)]
+    assert verdicts == [None, None, None, 'user', 'user']
+    assert throttle.admit(fake_update(2, "page|0")) is None
+
+
+def test_throttle_drops_beyond_global_rate():
+    throttle = bot.UpdateThrottle(user_rate=100, user_burst=100, global_rate=2, window=0)
+    verdicts = [throttle.admit(fake_update(user_id)) for user_id in range(4)]
+    assert verdicts == [None, None, 'global', 'global']
+
+
+def test_throttle_global_drop_refunds_the_user_token():
+    throttle = bot.UpdateThrottle(user_rate=0.001, user_burst=1, global_rate=1, window=0)
+    assert throttle.admit(fake_update(1)) is None
+    assert throttle.admit(fake_update(2)) == 'global'
+    throttle.overall.refund()
+    assert throttle.admit(fake_update(2)) is None
+
+
+def test_throttle_answers_every_rejected_press_but_warns_once():
+    throttle = bot.UpdateThrottle(user_rate=0.001, user_burst=1, global_rate=0, window=60)
+    answers = []
+
+    async def answer(text=None):
+        answers.append(text)
+
+    async def scenario():
+        for data in ("page|1", "page|1", "page|2", "page|3"):
+            update = fake_update(1, data)
+            update.callback_query.answer = answer
+            reason = throttle.admit(update)
+            if reason:
+                await throttle.reject(update, reason)
+
+    asyncio.run(scenario())
+    assert answers == [None, "⏳ Too many taps, please slow down", None]
+
+
+def test_throttle_never_limits_the_admin(monkeypatch):
+    monkeypatch.setattr(bot, "ADMIN_USERNAME", "boss")
+    throttle = bot.UpdateThrottle(user_rate=0.001, user_burst=1, global_rate=0, window=60)
+    assert all(throttle.admit(fake_update(1, "admin_stats", username="boss")) is None for _ in range(5))
+
+
+def test_throttle_forgets_least_recently_seen_users():
+    throttle = bot.UpdateThrottle(global_rate=0, max_users=2)
+    for user_id in (1, 2, 1, 3):
+        throttle.admit(fake_update(user_id))
+    assert len(throttle) == 2
+    assert list(throttle._users) == [1, 3]
+
+
+# ---- Tree documents ----
+def test_flatten_tree_round_trips_build_tree():
+    folders = [('/Math', 'Math', '/'), ('/Math/Week 1', 'Week 1', '/Math')]
+    files = [('a.pdf', '/Math/Week 1', 'fa', 'document', 10, 'ua'), ('b.mp3', '/Math', 'fb', 'audio', 0, None)]
+    got_folders, got_files = bot.flatten_tree(bot.build_tree(folders, files))
+    assert got_folders == folders
+    assert sorted(got_files) == sorted(files)
+
+
+def test_flatten_tree_accepts_legacy_file_ids():
+    folders, files = bot.flatten_tree({'subfolders': {'A': {'files': {'x.pdf': 'fid'}}}})
+    assert folders == [('/A', 'A', '/')]
+    assert files == [('x.pdf', '/A', 'fid', 'document', 0, None)]
+
+
+@pytest.mark.parametrize("document", [
+    [],
+    {'subfolders': {'a/b': {}}},
+    {'subfolders': {'A': 'not a folder'}},
+    {'files': {'x.pdf': {}}},
+    {'files': {'x.pdf': {'file_id': 'f', 'file_size': 'big'}}},
+    {'files': {'x.pdf': {'file_id': 'f', 'file_size': 1e400}}},
+    {'files': ['a']},
+    {'subfolders': ['A']},
+])
+def test_flatten_tree_rejects_malformed_documents(document):
+    with pytest.raises(ValueError):
+        bot.flatten_tree(document)
+
+
+# ---- Bulk downloads ----
+def download_buttons(folder_data):
+    return [row[0].callback_data for row in bot.build_folder_buttons(folder_data)
+            if row[0].callback_data.startswith("download_folder")]
+
+
+def test_download_all_shows_when_subfolders_fill_the_first_page():
+    page = {'subfolders': {f"s{i}": i for i in range(20)}, 'files': {}, 'page': 0, 'has_next': True, 'has_files': True}
+    assert download_buttons(page) == ["download_folder|0", "download_folder|1"]
+    assert download_buttons(dict(page, has_files=False)) == ["download_folder|1"]
+    assert download_buttons({'subfolders': {}, 'files': {'a.pdf': 1}}) == ["download_folder|0"]
+
+
+def test_plan_media_groups_splits_by_kind_and_size():
+    files = [(f"d{i}.pdf", f"d{i}", 'document') for i in range(12)]
+    files += [("p.jpg", "p", 'photo'), ("v.mp4", "v", 'video'), ("a.mp3", "a", 'audio'), ("x", "x", 'sticker')]
+    groups = bot.plan_media_groups(files)
+    assert [len(group) for group in groups] == [10, 3, 2, 1]
+    assert {file_type for _, _, file_type in groups[2]} == {'photo', 'video'}
+    assert ('x', 'x', 'document') in groups[1]
+
+
+# ---- Upload batching ----
+def test_upload_batcher_stop_writes_batches_still_waiting_on_their_timer(monkeypatch):
+    stored, replies = [], []
+
+    class FakeDB:
+        async def find_copies(self, unique_ids):
+            return {}
+
+        async def add_files(self, folder_path, files):
+            stored.append((folder_path, [info[0] for info in files]))
+            return True
+
+    class FakeMessage:
+        async def reply_text(self, text, **kwargs):
+            replies.append(text)
+
+    monkeypatch.setattr(bot, "db", FakeDB())
+    batcher = bot.UploadBatcher(window=60)
+
+    async def scenario():
+        for name in ("a.pdf", "b.pdf"):
+            batcher.add(None, 1, "/Math", (name, f"id-{name}", "document", 10, None), FakeMessage())
+        await batcher.stop()
+
+    asyncio.run(scenario())
+    assert stored == [("/Math", ["a.pdf", "b.pdf"])]
+    assert len(replies) == 1 and not batcher._batches
+
+
+# ---- Prewarm schedule ----
+def test_next_lecture_prewarm_picks_the_next_hour_minus_lead():
+    zone = ZoneInfo("Europe/Berlin")
+    now = datetime(2026, 3, 2, 9, 0, tzinfo=zone)
+    assert bot.next_lecture_prewarm(now, hours=[8, 14], lead=120) == (5 * 3600 - 120, 14)
+
+
+def test_next_lecture_prewarm_wraps_to_tomorrow():
+    now = datetime(2026, 3, 2, 15, 0, tzinfo=ZoneInfo("UTC"))
+    assert bot.next_lecture_prewarm(now, hours=[8], lead=60) == (17 * 3600 - 60, 8)
+
+
+# ---- Sessions ----
+def test_session_store_evicts_idle_and_excess_users_but_keeps_dirty_ones(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    store = bot.SessionStore(bot.MemorySessionBackend(), idle_ttl=60, max_users=2)
+
+    async def scenario():
+        await store.get(1)
+        await store.get(2)
+        store.save(2)
+        now[0] += 120
+        await store.get(3)
+        store.evict()
+        assert set(store._sessions) == {2, 3}  # 1 idle and clean, 2 idle but unsaved
+        await store.flush()
+        store.evict()
+        assert set(store._sessions) == {3}
+
+    asyncio.run(scenario())
+
+
+class SharedBackend:
+    """A session table another replica writes to"""
+    shared = True
+
+    def __init__(self):
+        self.rows = {}
+
+    async def load(self, user_id):
+        return self.rows.get(user_id)
+
+    async def save_many(self, rows):
+        for user_id, path, upload_path in rows:
+            self.rows[user_id] = (path, upload_path)
+        return True
+
+
+def test_session_store_rereads_clean_sessions_from_a_shared_backend(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    backend = SharedBackend()
+    store = bot.SessionStore(backend, refresh_interval=5)
+
+    async def scenario():
+        session = await store.get(1)
+        backend.rows[1] = ('/Math', None)  # written by another replica
+        assert (await store.get(1)).path == '/'
+        now[0] += 6
+        assert (await store.get(1)).path == '/Math'
+
+        session.path = '/Physics'
+        store.save(1)
+        backend.rows[1] = ('/Chemistry', None)
+        now[0] += 6
+        assert (await store.get(1)).path == '/Physics'  # a pending local change wins
+        await store.flush()
+        assert backend.rows[1] == ('/Physics', None)
+
+    asyncio.run(scenario())
+
+
+def test_session_store_does_not_reread_a_session_while_it_is_being_saved(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    backend = SharedBackend()
+    backend.rows[1] = ('/', None)
+    store = bot.SessionStore(backend, refresh_interval=5)
+    release = asyncio.Event()
+    save_many = backend.save_many
+
+    async def slow_save_many(rows):
+        await release.wait()
+        return await save_many(rows)
+    backend.save_many = slow_save_many
+
+    async def scenario():
+        session = await store.get(1)
+        session.path = '/Math'
+        store.save(1)
+        flush = asyncio.create_task(store.flush())
+        await asyncio.sleep(0)
+        now[0] += 6
+        assert (await store.get(1)).path == '/Math'  # the stored row is still stale
+        release.set()
+        await flush
+        assert backend.rows[1] == ('/Math', None)
+        now[0] += 6
+        assert (await store.get(1)).path == '/Math'
+
+    asyncio.run(scenario())
+
+
+def test_session_store_discards_a_reread_that_raced_a_local_change(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    backend = SharedBackend()
+    backend.rows[1] = ('/', None)
+    store = bot.SessionStore(backend, refresh_interval=5)
+
+    async def scenario():
+        session = await store.get(1)
+        load = backend.load
+
+        async def load_then_tap(user_id):
+            saved = await load(user_id)
+            session.path = '/Physics'  # a concurrent tap on this replica
+            store.save(1)
+            await store.flush()
+            return saved
+        backend.load = load_then_tap
+        now[0] += 6
+        assert (await store.get(1)).path == '/Physics'
+
+    asyncio.run(scenario())
+
+
+def test_session_store_does_not_reread_by_default():
+    assert bot.SessionStore(SharedBackend()).refresh_interval == 0
+
+
+def test_session_store_never_rereads_a_local_backend(monkeypatch):
+    store = bot.SessionStore(bot.MemorySessionBackend(), refresh_interval=5)
+    assert store.refresh_interval == 0
+
+
+# ---- Callback routing ----
+class FakeQuery:
+    def __init__(self, data):
+        self.data = data
+        self.from_user = SimpleNamespace(id=1, username="student")
+        self.answers = []
+
+    async def answer(self, text=None, show_alert=False):
+        self.answers.append(text)
+
+
+def test_router_parses_payloads_and_ignores_malformed_data(monkeypatch):
+    monkeypatch.setattr(bot, "db", object())
+    router = bot.CallbackRouter()
+    seen = []
+
+    @router.route("open", payload=int, session=False)
+    async def open_route(press, context):
+        seen.append(press.payload)
+
+    @router.route("flag", payload=bot.parse_flag, session=False)
+    async def flag_route(press, context):
+        seen.append(press.payload)
+
+    async def press(data):
+        await router.dispatch(SimpleNamespace(callback_query=FakeQuery(data)), None)
+
+    async def scenario():
+        for data in ("open|7", "open|x", "flag|1", "flag|0", "flag", "nope|1"):
+            await press(data)
+
+    asyncio.run(scenario())
+    assert seen == [7, True, False, False]
+
+
+def test_router_rejects_duplicate_routes():
+    router = bot.CallbackRouter()
+    router.route("a")(lambda press, context: None)
+    with pytest.raises(ValueError):
+        router.route("a")(lambda press, context: None)
+
+
+def test_router_keeps_admin_routes_for_the_admin(monkeypatch):
+    monkeypatch.setattr(bot, "db", object())
+    router = bot.CallbackRouter()
+    calls = []
+
+    @router.route("secret", admin=True, session=False)
+    async def secret(press, context):
+        calls.append(press.user.id)
+
+    query = FakeQuery("secret")
+    asyncio.run(router.dispatch(SimpleNamespace(callback_query=query), None))
+    assert calls == []
+    assert query.answers[-1] == "⛔ Admin access required"
+
+
+def test_delete_file_menu_pages_through_files_only(monkeypatch):
+    files = {f"f{i:03}.pdf": i for i in range(45)}
+    requests, shown = [], []
+
+    class FakeDB:
+        async def get_folder_page(self, path, page=0, page_size=20, kind=None):
+            requests.append((path, page, kind))
+            names = sorted(files)[page * page_size:(page + 1) * page_size]
+            return {'subfolders': {}, 'files': {name: files[name] for name in names},
+                    'page': page, 'has_next': len(files) > (page + 1) * page_size}
+
+    async def fake_edit(query, text, reply_markup=None, **kwargs):
+        shown.append([[button.callback_data for button in row] for row in reply_markup.inline_keyboard])
+
+    monkeypatch.setattr(bot, "db", FakeDB())
+    monkeypatch.setattr(bot, "safe_edit_message", fake_edit)
+    handler = bot.callbacks.routes["delete_file_current"][0]
+
+    async def scenario():
+        for raw in ("", "1", "2"):
+            press = bot.ButtonPress(FakeQuery(f"delete_file_current|{raw}"), bot.parse_page(raw), bot.UserSession('/Math'))
+            await handler(press, None)
+
+    asyncio.run(scenario())
+    assert requests == [('/Math', 0, 'files'), ('/Math', 1, 'files'), ('/Math', 2, 'files')]
+    assert shown[0][0] == ["delete_file_select|0"] and shown[0][20] == ["delete_file_current|1"]
+    assert shown[1][20] == ["delete_file_current|0", "delete_file_current|2"]
+    assert len(shown[2]) == 5 + 1 + 2 and shown[2][5] == ["delete_file_current|1"]